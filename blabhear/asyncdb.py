@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import time
+import uuid
+import weakref
+
+import asyncpg
+from django.conf import settings
+from django.db import connections
+
+from blabhear import metrics, replicas, tracing
+from blabhear.instrumentation import command_label
+from blabhear.models import RecordingSettings
+
+# Native asyncpg versions of the hottest RoomConsumer helpers. Each mirrors
+# the ORM helper of the same name, including get_room's get_or_create of the
+# room row, but runs on a pooled connection without a thread hop.
+
+ENSURE_ROOM = """
+INSERT INTO blabhear_room (id, private, display_name)
+VALUES ($1::uuid, false, $1::uuid::text)
+ON CONFLICT (id) DO NOTHING
+"""
+
+USER_NOT_ALLOWED = """
+SELECT room.private AND NOT EXISTS (
+    SELECT 1 FROM blabhear_room_members member
+    WHERE member.room_id = room.id AND member.user_id = $2
+)
+FROM blabhear_room room
+WHERE room.id = $1
+"""
+
+GET_RECORDING_SETTINGS = """
+WITH room AS (
+    INSERT INTO blabhear_room (id, private, display_name)
+    VALUES ($1::uuid, false, $1::uuid::text)
+    ON CONFLICT (id) DO NOTHING
+), existing AS (
+    SELECT id, language, voice_effect FROM blabhear_recordingsettings
+    WHERE room_id = $1 AND user_id = $2
+    LIMIT 1
+), created AS (
+    INSERT INTO blabhear_recordingsettings (id, room_id, user_id, language, voice_effect)
+    SELECT $3, $1, $2, $4, $5
+    WHERE NOT EXISTS (SELECT 1 FROM existing)
+    RETURNING id, language, voice_effect
+)
+SELECT * FROM existing UNION ALL SELECT * FROM created
+"""
+
+INSERT_MESSAGE = """
+INSERT INTO blabhear_message (id, creator_id, room_id, content, created_at, filename, idempotency_key)
+VALUES ($1, $2, $3, $4, now(), $5, $6)
+ON CONFLICT (creator_id, room_id, idempotency_key) DO NOTHING
+RETURNING id, content, created_at, filename
+"""
+
+GET_MESSAGE_BY_KEY = """
+SELECT id, content, created_at, filename FROM blabhear_message
+WHERE creator_id = $1 AND room_id = $2 AND idempotency_key = $3
+"""
+
+# Rows are locked in id order so concurrent messages to one room queue up
+# behind each other instead of deadlocking.
+NOTIFY_ROOM_MEMBERS = """
+WITH members AS (
+    SELECT notification.id FROM blabhear_notification notification
+    JOIN blabhear_room_members member
+    ON member.room_id = notification.room_id AND member.user_id = notification.user_id
+    WHERE notification.room_id = $3
+    ORDER BY notification.id
+    FOR UPDATE OF notification
+)
+UPDATE blabhear_notification notification
+SET message_id = $1, read = notification.user_id = $2, timestamp = now()
+FROM members
+WHERE notification.id = members.id
+"""
+
+pools = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return settings.ASYNC_DATABASE and connections["default"].vendor == "postgresql"
+
+
+async def create_pool():
+    database = settings.DATABASES["default"]
+    return await asyncpg.create_pool(
+        host=database.get("HOST") or None,
+        port=database.get("PORT") or None,
+        user=database.get("USER") or None,
+        password=database.get("PASSWORD") or None,
+        database=database.get("NAME"),
+        min_size=1,
+        max_size=settings.ASYNC_DATABASE_POOL_SIZE,
+    )
+
+
+async def get_pool():
+    loop = asyncio.get_running_loop()
+    pool = pools.get(loop)
+    if pool is None:
+        pool = pools[loop] = loop.create_task(create_pool())
+    return await pool
+
+
+async def close_pool():
+    pool = pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await (await pool).close()
+
+
+@contextlib.asynccontextmanager
+async def observe(name, statements=1):
+    command = command_label()
+    started_at = time.perf_counter()
+    try:
+        with tracing.span(f"db.async.{name}"):
+            yield
+    finally:
+        metrics.db_queries.inc(statements, command=command)
+        metrics.db_query_seconds.inc(time.perf_counter() - started_at, command=command)
+
+
+async def user_not_allowed(room_id, user):
+    async with observe("user_not_allowed"):
+        pool = await get_pool()
+        not_allowed = await pool.fetchval(USER_NOT_ALLOWED, uuid.UUID(room_id), user.id)
+    return bool(not_allowed)
+
+
+async def get_recording_settings(room_id, user):
+    async with observe("get_recording_settings"):
+        pool = await get_pool()
+        row = await pool.fetchrow(
+            GET_RECORDING_SETTINGS,
+            uuid.UUID(room_id),
+            user.id,
+            uuid.uuid4(),
+            RecordingSettings.Language.ENGLISH.value,
+            "None",
+        )
+    # Built as if loaded by the ORM, so a cached copy can be saved later as
+    # an update rather than validated as a new row.
+    recording_settings = RecordingSettings.from_db(
+        "default",
+        ["id", "user_id", "room_id", "language", "voice_effect"],
+        [row["id"], user.id, uuid.UUID(room_id), row["language"], row["voice_effect"]],
+    )
+    recording_settings.user = user
+    return recording_settings
+
+
+async def create_new_message(room_id, user, content, filename, message_key=None):
+    message_key = message_key or None
+    async with observe("create_new_message", statements=3):
+        pool = await get_pool()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(ENSURE_ROOM, uuid.UUID(room_id))
+                row = await connection.fetchrow(
+                    INSERT_MESSAGE,
+                    uuid.uuid4(),
+                    user.id,
+                    uuid.UUID(room_id),
+                    content,
+                    uuid.UUID(filename) if filename else None,
+                    message_key,
+                )
+                created = row is not None
+                if created:
+                    await connection.execute(
+                        NOTIFY_ROOM_MEMBERS, row["id"], user.id, uuid.UUID(room_id)
+                    )
+                else:
+                    row = await connection.fetchrow(
+                        GET_MESSAGE_BY_KEY, user.id, uuid.UUID(room_id), message_key
+                    )
+    if created:
+        replicas.record_write()
+    return (
+        {
+            "creator__display_name": user.display_name,
+            "content": row["content"],
+            "creator__username": user.username,
+            "created_at": row["created_at"],
+            "filename": row["filename"],
+            "id": row["id"],
+        },
+        created,
+    )
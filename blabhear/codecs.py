@@ -0,0 +1,76 @@
+import datetime
+import uuid
+
+import msgpack
+import orjson
+
+DATETIME_FORMAT = "%d-%m-%Y %H:%M"
+
+
+def encode_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class JSONCodec:
+    subprotocol = None
+    binary = False
+
+    def encode(self, content):
+        return orjson.dumps(
+            content, default=encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        ).decode()
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    subprotocol = "blabhear.msgpack"
+    binary = True
+
+    def encode(self, content):
+        return msgpack.packb(content, default=encode_default, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CODEC = JSONCodec()
+CODECS = [MsgpackCodec()]
+
+
+def negotiate(subprotocols):
+    for codec in CODECS:
+        if codec.subprotocol in subprotocols:
+            return codec
+    return DEFAULT_CODEC
+
+
+class CodecConsumerMixin:
+    # Frames are encoded with the codec the client asked for through the
+    # WebSocket subprotocol, falling back to JSON text frames.
+
+    async def websocket_connect(self, message):
+        self.codec = negotiate(self.scope.get("subprotocols") or [])
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol or self.codec.subprotocol)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        data = bytes_data if self.codec.binary else text_data
+        if not data:
+            raise ValueError(
+                f"No {'bytes' if self.codec.binary else 'text'} section for incoming WebSocket frame!"
+            )
+        await self.receive_json(self.codec.decode(data), **kwargs)
+
+    async def send_json(self, content, close=False):
+        if self.codec.binary:
+            await self.send(bytes_data=self.codec.encode(content), close=close)
+        else:
+            await self.send(text_data=self.codec.encode(content), close=close)
@@ -1,17 +1,42 @@
 import asyncio
+import base64
+import collections
 import datetime
+import json
 import logging
 import os
+import time
 import uuid
+import weakref
 from operator import itemgetter
 
-from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from deepgram import Deepgram
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, EmptyPage
-
+from django.db import connection, transaction
+from django.db.models import Case, Exists, F, FloatField, OuterRef, Q, Value, When
+from django.db.models.functions import Cast, Now
+
+from blabhear import (
+    asyncdb,
+    eventlog,
+    layers,
+    metrics,
+    presence,
+    readstate,
+    tracing,
+)
+from blabhear.codecs import CodecConsumerMixin
 from blabhear.constants import LANGUAGES
+from blabhear.exceptions import DatabaseLaneFull
+from blabhear.instrumentation import (
+    InstrumentedConsumerMixin,
+    database_sync_to_async,
+)
 from blabhear.models import (
     Room,
     JoinRequest,
@@ -27,35 +52,121 @@ from blabhear.storage import (
 
 logger = logging.getLogger(__name__)
 DEEPGRAM_CLIENT = Deepgram(os.environ.get("DEEPGRAM_API_KEY"))
+MESSAGE_KEY_MAX_LENGTH = 64
+MESSAGE_KEY_CACHE_TIMEOUT = 300
+MESSAGE_KEY_PENDING = "pending"
+DOWNLOAD_URL_BATCH_SIZE = 50
+DOWNLOAD_URL_CACHE_TIMEOUT = 6 * 24 * 60 * 60
+SEARCH_PAGE_SIZE = 20
+SEARCH_QUERY_MAX_LENGTH = 200
+MULTIPLEX_MAX_ROOM_STREAMS = 50
+ROSTER_PAGE_SIZE = 100
+SYNC_MESSAGES_LIMIT = 100
+SYNC_IDS_LIMIT = 500
+
+
+def room_inbox_group(room_id):
+    return f"inbox.{room_id}"
+
+
+room_publish_locks = weakref.WeakValueDictionary()
+
+
+async def publish_room_event(channel_layer, room_id, event):
+    # Room changes are logged before they go out and carry their place in
+    # the log, so a client that drops can resume from the last seq it saw.
+    # Publishers in this process go out in seq order; ones racing from other
+    # processes can still arrive out of order, which clients repair with a
+    # resume when they see a gap.
+    lock = room_publish_locks.get(str(room_id))
+    if lock is None:
+        lock = room_publish_locks[str(room_id)] = asyncio.Lock()
+    async with lock:
+        event["seq"] = await eventlog.append(channel_layer, room_id, event)
+        await channel_layer.group_send(str(room_id), event)
+
+
+def encode_search_cursor(hit):
+    position = [hit["rank"], hit["created_at"].isoformat(), str(hit["id"])]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    rank, created_at, message_id = json.loads(base64.urlsafe_b64decode(cursor))
+    return (
+        float(rank),
+        datetime.datetime.fromisoformat(created_at),
+        uuid.UUID(message_id),
+    )
 
 
-class RoomConsumer(AsyncJsonWebsocketConsumer):
+def encode_roster_cursor(member):
+    return base64.urlsafe_b64encode(json.dumps(member["username"]).encode()).decode()
+
+
+def decode_roster_cursor(cursor):
+    username = json.loads(base64.urlsafe_b64decode(cursor))
+    if not isinstance(username, str):
+        raise ValueError("Invalid roster cursor")
+    return username
+
+
+class RoomConsumer(
+    InstrumentedConsumerMixin, CodecConsumerMixin, AsyncJsonWebsocketConsumer
+):
+    consumer_label = "room"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per-connection copies of the room row, the user's membership and
+        # their recording settings. The group events that announce a change
+        # to any of them swap in a fresh dict, so a helper still running in
+        # a thread can only write into the one that was thrown away.
+        self.room_state = {}
+
     def get_room(self, room_id):
-        room, created = Room.objects.get_or_create(id=room_id)
+        state = self.room_state
+        room = state.get("room")
+        if room is None or str(room.id) != str(room_id):
+            room, created = Room.objects.get_or_create(id=room_id)
+            state["room"] = room
         return room
 
-    def get_all_room_members(self):
-        room = Room.objects.filter(id=self.room_id)
-        if room.exists():
-            room = room.first()
-            members = room.members.all().values()
-        else:
-            members = []
-        member_display_names = [user["display_name"] for user in members]
-        member_usernames = [user["username"] for user in members]
-        return member_display_names, member_usernames
+    def is_room_member(self):
+        state = self.room_state
+        if "is_member" not in state:
+            room = self.get_room(self.room_id)
+            state["is_member"] = room.members.filter(id=self.user.id).exists()
+        return state["is_member"]
 
-    def add_user_to_room(self, user, room):
-        was_added = False
-        latest_message = room.message_set.order_by("-created_at").first()
-        if user not in room.members.all():
-            room.members.add(user)
-            Notification.objects.get_or_create(
-                user=user, room=room, defaults={"message": latest_message}
+    def invalidate_room_state(self, *keys):
+        self.room_state = {
+            key: value for key, value in self.room_state.items() if key not in keys
+        }
+
+    def get_all_room_members(self):
+        return list(
+            User.objects.filter(room=self.room_id).values_list(
+                "display_name", flat=True
             )
-            was_added = True
-        member_display_names, member_usernames = self.get_all_room_members()
-        return member_display_names, was_added
+        )
+
+    def get_roster_page(self, after=None):
+        # Members in username order, one page at a time, so a client can walk
+        # a large room's roster without it ever being sent in one frame.
+        members = User.objects.filter(room=self.room_id)
+        if after is not None:
+            members = members.filter(username__gt=after)
+        page = list(
+            members.order_by("username").values("username", "display_name")[
+                : ROSTER_PAGE_SIZE + 1
+            ]
+        )
+        next_cursor = None
+        if len(page) > ROSTER_PAGE_SIZE:
+            page = page[:ROSTER_PAGE_SIZE]
+            next_cursor = encode_roster_cursor(page[-1])
+        return page, next_cursor
 
     def set_room_privacy(self, private):
         room = self.get_room(self.room_id)
@@ -63,12 +174,14 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         room.save()
 
     def user_not_allowed(self):
-        room = Room.objects.filter(id=self.room_id)
-        if room.exists():
-            room = room.first()
-            return self.user not in room.members.all() and room.private
-        else:
-            return False
+        state = self.room_state
+        room = state.get("room")
+        if room is None:
+            room = Room.objects.filter(id=self.room_id).first()
+            if room is None:
+                return False
+            state["room"] = room
+        return room.private and not self.is_room_member()
 
     def get_all_join_requests(self):
         room = self.get_room(self.room_id)
@@ -97,82 +210,134 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             user=user, room=room, defaults={"message": latest_message}
         )
         room.joinrequest_set.filter(user=user).delete()
+        return {"username": user.username, "display_name": user.display_name}
 
     def approve_all_room_members(self):
-        added_users = []
         room = self.get_room(self.room_id)
-        latest_message = room.message_set.order_by("-created_at").first()
-        for request in room.joinrequest_set.all():
-            room.members.add(request.user)
-            Notification.objects.get_or_create(
-                user=request.user, room=room, defaults={"message": latest_message}
+        users = [
+            request.user for request in room.joinrequest_set.select_related("user")
+        ]
+        if users:
+            latest_message = room.message_set.order_by("-created_at").first()
+            room.members.add(*users)
+            notified = set(
+                Notification.objects.filter(room=room, user__in=users).values_list(
+                    "user_id", flat=True
+                )
             )
-            added_users.append(request.user.username)
-        room.joinrequest_set.all().delete()
-        return added_users
+            Notification.objects.bulk_create(
+                [
+                    Notification(user=user, room=room, message=latest_message)
+                    for user in users
+                    if user.id not in notified
+                ]
+            )
+            room.joinrequest_set.all().delete()
+        return [
+            {"username": user.username, "display_name": user.display_name}
+            for user in users
+        ]
 
     def change_display_name(self, new_name):
         room = self.get_room(self.room_id)
         room.display_name = new_name
         room.save()
-        users_to_refresh = [
-            str(user["username"]) for user in room.members.all().values()
-        ]
-        return new_name, users_to_refresh
-
-    def read_unread_room_notification(self):
-        room = self.get_room(self.room_id)
-        room_notification = Notification.objects.get(user=self.user, room=room)
-        if not room_notification.read:
-            room_notification.read = True
-            room_notification.save()
+        return new_name
 
     def create_new_message_notification_for_all_room_members(self, new_message):
         room = self.get_room(self.room_id)
-        for user in room.members.all():
-            notification = Notification.objects.get(user=user, room=room)
-            notification.message = new_message
-            notification.read = user == self.user
-            notification.save()
-
-    def create_new_message(self, content, filename):
-        room = self.get_room(self.room_id)
-        new_message = Message.objects.create(
-            creator=self.user, room=room, content=content, filename=filename
+        Notification.objects.filter(
+            room=room,
+            user__in=Room.members.through.objects.filter(room=room).values("user"),
+        ).update(
+            message=new_message,
+            read=Case(When(user=self.user, then=True), default=False),
+            timestamp=Now(),
         )
-        self.create_new_message_notification_for_all_room_members(new_message)
+
+    def serialize_new_message(self, new_message):
         return {
             "creator__display_name": new_message.creator.display_name,
             "content": new_message.content,
             "creator__username": new_message.creator.username,
-            "created_at": new_message.created_at.strftime("%d-%m-%Y %H:%M"),
-            "filename": str(new_message.filename),
-            "download": generate_download_signed_url_v4(str(new_message.filename)),
-            "id": str(new_message.id),
+            "created_at": new_message.created_at,
+            "filename": new_message.filename,
+            "id": new_message.id,
         }
 
+    def create_new_message(self, content, filename, message_key=None):
+        room = self.get_room(self.room_id)
+        # A message key is only spent once its notifications are written too,
+        # otherwise a retry would find the message and skip the fan-out.
+        with transaction.atomic():
+            if message_key:
+                new_message, created = Message.objects.get_or_create(
+                    creator=self.user,
+                    room=room,
+                    idempotency_key=message_key,
+                    defaults={"content": content, "filename": filename},
+                )
+            else:
+                new_message = Message.objects.create(
+                    creator=self.user, room=room, content=content, filename=filename
+                )
+                created = True
+            if created:
+                self.create_new_message_notification_for_all_room_members(new_message)
+        return self.serialize_new_message(new_message), created
+
+    def get_message_by_key(self, message_key):
+        message = Message.objects.filter(
+            creator=self.user, room_id=self.room_id, idempotency_key=message_key
+        ).first()
+        if message:
+            return self.serialize_new_message(message)
+
     def edit_message_content(self, message_id, new_content):
-        message = Message.objects.get(id=message_id)
-        if message.creator == self.user:
-            message.edited_at = datetime.datetime.now(tz=datetime.timezone.utc)
-            message.content = new_content
-            message.save()
-        notifications_with_message = Notification.objects.filter(message=message)
+        edited_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        edited = Message.objects.filter(
+            id=message_id, room_id=self.room_id, creator=self.user
+        ).update(content=new_content, edited_at=edited_at)
+        if not edited:
+            return None, []
+        usernames = list(
+            Notification.objects.filter(message_id=message_id).values_list(
+                "user__username", flat=True
+            )
+        )
+        return edited_at, usernames
+
+    def get_playable_filenames(self, filenames):
         return [
-            notification["user__username"]
-            for notification in notifications_with_message.values("user__username")
+            str(filename)
+            for filename in Message.objects.filter(
+                room_id=self.room_id, filename__in=filenames
+            ).values_list("filename", flat=True)
         ]
 
+    def sign_download_urls(self, filenames):
+        return {
+            filename: generate_download_signed_url_v4(filename)
+            for filename in filenames
+        }
+
+    def sign_upload_urls(self, filenames):
+        return {
+            filename: generate_upload_signed_url_v4(filename) for filename in filenames
+        }
+
     def get_recording_settings(self):
-        room = self.get_room(self.room_id)
-        settings, created = RecordingSettings.objects.get_or_create(
-            room=room, user=self.user
-        )
-        return settings
+        state = self.room_state
+        if "recording_settings" not in state:
+            room = self.get_room(self.room_id)
+            settings, created = RecordingSettings.objects.get_or_create(
+                room=room, user=self.user
+            )
+            state["recording_settings"] = settings
+        return state["recording_settings"]
 
     def update_language(self, new_language_name):
-        room = self.get_room(self.room_id)
-        settings = RecordingSettings.objects.get(room=room, user=self.user)
+        settings = self.get_recording_settings()
         for language in LANGUAGES:
             if language[0] == new_language_name:
                 new_language = language[1]
@@ -181,8 +346,7 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         return settings
 
     def update_voice_effect(self, new_voice_effect):
-        room = self.get_room(self.room_id)
-        settings = RecordingSettings.objects.get(room=room, user=self.user)
+        settings = self.get_recording_settings()
         settings.voice_effect = new_voice_effect
         settings.save()
         return settings
@@ -204,23 +368,56 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             )
             message_page = messages.page(page)
             message_page_display_order = message_page.object_list[::-1]
-            for message in message_page_display_order:
-                if message["edited_at"]:
-                    message["edited_at"] = message["edited_at"].strftime(
-                        "%d-%m-%Y %H:%M"
-                    )
-                message["created_at"] = message["created_at"].strftime("%d-%m-%Y %H:%M")
-                message["filename"] = str(message["filename"])
-                message["id"] = str(message["id"])
-                message["download"] = generate_download_signed_url_v4(
-                    str(message["filename"])
-                )
             return message_page_display_order, page
         except ObjectDoesNotExist:
             pass
         except EmptyPage:
             return [], page
 
+    def sync_messages_since(self, newest_id, held_ids):
+        # Both lookups walk an index from the client's newest message onwards:
+        # (room, created_at) for new messages and the partial (room,
+        # edited_at) one for edits, so the cost follows the amount of change.
+        newest = (
+            Message.objects.filter(room=self.room_id, id=newest_id)
+            .values_list("created_at", flat=True)
+            .first()
+        )
+        if newest is None:
+            return [], [], False
+        created = list(
+            Message.objects.filter(room=self.room_id, created_at__gte=newest)
+            .exclude(created_at=newest, id__lte=newest_id)
+            .order_by("created_at", "id")
+            .values(
+                "creator__display_name",
+                "content",
+                "creator__username",
+                "created_at",
+                "edited_at",
+                "filename",
+                "id",
+            )[: SYNC_MESSAGES_LIMIT + 1]
+        )
+        edited = Message.objects.filter(
+            room=self.room_id, edited_at__gt=newest, created_at__lte=newest
+        )
+        if held_ids is not None:
+            edited = edited.filter(id__in=held_ids)
+        edited = list(
+            edited.order_by("edited_at").values("id", "content", "edited_at")[
+                : SYNC_MESSAGES_LIMIT + 1
+            ]
+        )
+        complete = (
+            len(created) <= SYNC_MESSAGES_LIMIT and len(edited) <= SYNC_MESSAGES_LIMIT
+        )
+        return (
+            created[:SYNC_MESSAGES_LIMIT],
+            edited[:SYNC_MESSAGES_LIMIT],
+            complete,
+        )
+
     def fetch_messages_up_to_page(self, *, page):
         accumulated_messages = []
         room = self.get_room(self.room_id)
@@ -245,135 +442,366 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
                 break
             except EmptyPage:
                 break
-        for message in accumulated_messages:
-            if message["edited_at"]:
-                message["edited_at"] = message["edited_at"].strftime("%d-%m-%Y %H:%M")
-            message["created_at"] = message["created_at"].strftime("%d-%m-%Y %H:%M")
-            message["filename"] = str(message["filename"])
-            message["id"] = str(message["id"])
-            message["download"] = generate_download_signed_url_v4(
-                str(message["filename"])
-            )
         return accumulated_messages, page
 
+    def serialize_recording_settings(self, recording_settings):
+        language_name = "Not Found"
+        for language in LANGUAGES:
+            if language[1] == recording_settings.language:
+                language_name = language[0]
+        if language_name == "Not Found":
+            logger.error(
+                f"Could not find language name for language {recording_settings.language} in recording settings for "
+                f"user {recording_settings.user} in room {recording_settings.room}"
+            )
+        return {
+            "language_name": language_name,
+            "voice_effect": recording_settings.voice_effect,
+        }
+
+    def bootstrap_room(self):
+        # Everything a client needs to open a room, in one thread hop: the
+        # membership check and room fields come from a single query, and the
+        # rest is one query per section instead of a get_room each.
+        room = (
+            Room.objects.filter(id=self.room_id)
+            .annotate(
+                is_member=Exists(
+                    Room.members.through.objects.filter(
+                        room_id=OuterRef("id"), user_id=self.user.id
+                    )
+                )
+            )
+            .first()
+        )
+        if room is None:
+            room = self.get_room(self.room_id)
+            room.is_member = False
+        state = self.room_state
+        state["room"] = room
+        if room.private and not room.is_member:
+            state["is_member"] = False
+            JoinRequest.objects.get_or_create(user=self.user, room=room)
+            return None, False
+        state["is_member"] = True
+        was_added = not room.is_member
+        if was_added:
+            room.members.add(self.user)
+            latest_message = room.message_set.order_by("-created_at").first()
+            Notification.objects.get_or_create(
+                user=self.user, room=room, defaults={"message": latest_message}
+            )
+        messages = list(
+            room.message_set.order_by("-created_at").values(
+                "creator__display_name",
+                "content",
+                "creator__username",
+                "created_at",
+                "edited_at",
+                "filename",
+                "id",
+            )[:10]
+        )
+        recording_settings = self.get_recording_settings()
+        roster, roster_cursor = self.get_roster_page()
+        state["seen_message_id"] = messages[0]["id"] if messages else None
+        return {
+            "display_name": room.display_name,
+            "privacy": room.private,
+            "roster": roster,
+            "roster_cursor": roster_cursor,
+            "messages": messages[::-1],
+            "page": 1,
+            "join_requests": list(
+                room.joinrequest_set.order_by("-timestamp").values(
+                    "user", "user__username", "user__display_name"
+                )
+            ),
+            "recording_settings": self.serialize_recording_settings(recording_settings),
+        }, was_added
+
+    async def check_user_not_allowed(self):
+        state = self.room_state
+        if "room" in state and "is_member" in state:
+            return state["room"].private and not state["is_member"]
+        if asyncdb.enabled():
+            return await asyncdb.user_not_allowed(self.room_id, self.user)
+        return await database_sync_to_async(self.user_not_allowed)()
+
+    def get_latest_message_id(self):
+        return (
+            Message.objects.filter(room=self.room_id)
+            .order_by("-created_at")
+            .values_list("id", flat=True)
+            .first()
+        )
+
+    async def mark_room_notification_read(self):
+        # A read only clears the notification while it still points at the
+        # newest message this connection has shown.
+        state = self.room_state
+        if "seen_message_id" not in state:
+            state["seen_message_id"] = await database_sync_to_async(
+                self.get_latest_message_id
+            )()
+        await readstate.mark_read(
+            self.channel_layer, self.user.id, self.room_id, state["seen_message_id"]
+        )
+
+    async def load_recording_settings(self):
+        state = self.room_state
+        if "recording_settings" in state:
+            return state["recording_settings"]
+        if asyncdb.enabled():
+            state["recording_settings"] = await asyncdb.get_recording_settings(
+                self.room_id, self.user
+            )
+            return state["recording_settings"]
+        return await database_sync_to_async(self.get_recording_settings)()
+
+    async def save_new_message(self, content, filename, message_key=None):
+        if asyncdb.enabled():
+            return await asyncdb.create_new_message(
+                self.room_id, self.user, content, filename, message_key
+            )
+        return await database_sync_to_async(self.create_new_message)(
+            content, filename, message_key
+        )
+
     async def connect(self):
         await self.accept()
         self.user = self.scope["user"]
+        self.activity = None
+        self.presence_room = None
+        self.presence_task = None
+        readstate.start(self.channel_layer)
+
+    async def resume_room(self, last_seq):
+        # A member coming back only needs what happened while they were away,
+        # as long as the room's event log still reaches back that far.
+        if not await database_sync_to_async(self.is_room_member)():
+            return False
+        events = await eventlog.missed(self.channel_layer, self.room_id, last_seq)
+        if events is None:
+            return False
+        for event in events:
+            if event["type"] == "new_message":
+                self.room_state["seen_message_id"] = event["new_message"]["id"]
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                "type": "room_resumed",
+                "room": self.room_id,
+                "seq": events[-1]["seq"] if events else last_seq,
+                "events": events,
+            },
+        )
+        await self.mark_room_notification_read()
+        await self.start_presence()
+        return True
 
-    async def initialize_room(self):
+    async def initialize_room(self, last_seq=None):
         await self.channel_layer.group_add(self.room_id, self.channel_name)
-        room = await database_sync_to_async(self.get_room)(self.room_id)
-        user_not_allowed = await database_sync_to_async(self.user_not_allowed)()
-        if user_not_allowed:
+        if isinstance(last_seq, int) and await self.resume_room(last_seq):
+            return
+        # Read before the snapshot, so anything logged while it is built is
+        # replayed on a later resume rather than skipped.
+        seq = await eventlog.latest(self.channel_layer, self.room_id)
+        bootstrap, was_added = await database_sync_to_async(self.bootstrap_room)()
+        if bootstrap is None:
             await self.channel_layer.send(
                 self.channel_name,
                 {"type": "allowed", "allowed": False, "room": self.room_id},
             )
-            await database_sync_to_async(self.get_or_create_new_join_request)()
             await self.channel_layer.group_send(
                 self.room_id,
                 {"type": "refresh_join_requests"},
             )
-        else:
-            await self.channel_layer.send(
-                self.channel_name,
-                {"type": "allowed", "allowed": True, "room": self.room_id},
+            return
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                "type": "room_bootstrap",
+                "allowed": True,
+                "room": self.room_id,
+                "seq": seq,
+                **bootstrap,
+            },
+        )
+        await self.mark_room_notification_read()
+        if was_added:
+            await publish_room_event(
+                self.channel_layer,
+                self.room_id,
+                {
+                    "type": "member_added",
+                    "members": [
+                        {
+                            "username": self.user.username,
+                            "display_name": self.user.display_name,
+                        }
+                    ],
+                },
             )
-            members, was_added = await database_sync_to_async(self.add_user_to_room)(
-                self.user, room
+            await self.channel_layer.group_send(
+                self.user.username,
+                {"type": "subscribe_inbox", "room": self.room_id},
             )
-            if was_added:
-                await self.channel_layer.group_send(
-                    self.room_id,
-                    {"type": "refresh_members"},
-                )
-            else:
-                await self.channel_layer.send(
-                    self.channel_name, {"type": "members", "members": members}
-                )
-            await database_sync_to_async(self.read_unread_room_notification)()
+        else:
             await self.channel_layer.group_send(
                 self.user.username,
                 {
                     "type": "refresh_notifications",
                 },
             )
-            await self.get_room_messages_up_to_page(page=1)
-            await self.fetch_display_name()
-            await self.fetch_privacy()
-            await self.fetch_join_requests()
-            await self.fetch_recording_settings()
+        await self.start_presence()
 
     async def disconnect(self, close_code):
+        await self.stop_presence()
         await self.channel_layer.group_discard(str(self.room_id), self.channel_name)
 
+    async def start_presence(self):
+        await self.stop_presence()
+        self.presence_room = self.room_id
+        await self.update_presence()
+        self.presence_task = asyncio.create_task(self.refresh_presence())
+
+    async def stop_presence(self):
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+            self.presence_task = None
+        if self.presence_room is not None:
+            room_id, self.presence_room = self.presence_room, None
+            self.activity = None
+            store = presence.get_store(self.channel_layer)
+            await store.update(
+                room_id, self.channel_name, self.user.username, None, set()
+            )
+            presence.schedule_broadcast(self.channel_layer, store, room_id)
+
+    async def update_presence(self):
+        states = {"online", self.activity} if self.activity else {"online"}
+        store = presence.get_store(self.channel_layer)
+        await store.update(
+            self.presence_room,
+            self.channel_name,
+            self.user.username,
+            self.user.display_name,
+            states,
+        )
+        presence.schedule_broadcast(self.channel_layer, store, self.presence_room)
+
+    async def refresh_presence(self):
+        store = presence.get_store(self.channel_layer)
+        while True:
+            await asyncio.sleep(presence.HEARTBEAT_INTERVAL)
+            states = {"online", self.activity} if self.activity else {"online"}
+            try:
+                # A heartbeat that re-adds this connection or prunes expired
+                # ones changes what the room sees, so it is broadcast too.
+                changed = await store.update(
+                    self.presence_room,
+                    self.channel_name,
+                    self.user.username,
+                    self.user.display_name,
+                    states,
+                )
+                if changed:
+                    presence.schedule_broadcast(
+                        self.channel_layer, store, self.presence_room
+                    )
+            except Exception:
+                logger.exception(f"Failed to refresh presence for {self.user}")
+
+    async def set_activity(self, input_payload):
+        activity = input_payload.get("activity")
+        if activity not in presence.ACTIVITIES:
+            activity = None
+        if self.presence_room is not None and activity != self.activity:
+            self.activity = activity
+            await self.update_presence()
+
+    async def fetch_presence(self):
+        if self.presence_room is None:
+            return
+        snapshot = await presence.get_store(self.channel_layer).snapshot(
+            self.presence_room
+        )
+        await self.channel_layer.send(
+            self.channel_name, {"type": "presence", **snapshot}
+        )
+
     async def receive_json(self, content, **kwargs):
+        command = content.get("command")
         if content.get("command") == "connect":
             self.room_id = content.get("room")
-            await self.initialize_room()
+            self.room_state = {}
+            await self.observe_command(
+                command, self.initialize_room(content.get("last_seq"))
+            )
+            return
         if content.get("command") == "disconnect":
+            await self.stop_presence()
             await self.channel_layer.group_discard(str(self.room_id), self.channel_name)
-        user_not_allowed = await database_sync_to_async(self.user_not_allowed)()
+        if content.get("command") == "set_activity":
+            self.create_command_task(command, self.set_activity(content))
+            return
+        if content.get("command") == "fetch_presence":
+            self.create_command_task(command, self.fetch_presence())
+            return
+        try:
+            user_not_allowed = await self.check_user_not_allowed()
+        except DatabaseLaneFull:
+            await self.send_retry(command)
+            return
         user_allowed = not user_not_allowed
         if content.get("command") == "fetch_allowed_status":
-            asyncio.create_task(self.fetch_allowed_status(user_allowed))
+            self.create_command_task(command, self.fetch_allowed_status(user_allowed))
         elif user_allowed:
             if content.get("command") == "change_voice_effect":
-                asyncio.create_task(self.change_voice_effect(content))
+                self.create_command_task(command, self.change_voice_effect(content))
             if content.get("command") == "change_language":
-                asyncio.create_task(self.change_language(content))
+                self.create_command_task(command, self.change_language(content))
             if content.get("command") == "update_privacy":
-                asyncio.create_task(self.update_privacy(content))
+                self.create_command_task(command, self.update_privacy(content))
             if content.get("command") == "fetch_privacy":
-                asyncio.create_task(self.fetch_privacy())
+                self.create_command_task(command, self.fetch_privacy())
             if content.get("command") == "fetch_join_requests":
-                asyncio.create_task(self.fetch_join_requests())
+                self.create_command_task(command, self.fetch_join_requests())
             if content.get("command") == "fetch_members":
-                asyncio.create_task(self.fetch_members())
+                self.create_command_task(command, self.fetch_members())
+            if content.get("command") == "fetch_roster":
+                self.create_command_task(command, self.fetch_roster(content))
             if content.get("command") == "reject_user":
-                asyncio.create_task(self.reject_user(content))
+                self.create_command_task(command, self.reject_user(content))
             if content.get("command") == "approve_user":
-                asyncio.create_task(self.approve_user(content))
+                self.create_command_task(command, self.approve_user(content))
             if content.get("command") == "approve_all_users":
-                asyncio.create_task(self.approve_all_users())
+                self.create_command_task(command, self.approve_all_users())
             if content.get("command") == "update_display_name":
-                asyncio.create_task(self.update_display_name(content))
+                self.create_command_task(command, self.update_display_name(content))
             if content.get("command") == "send_message":
-                asyncio.create_task(self.send_message(content))
+                self.create_command_task(command, self.send_message(content))
             if content.get("command") == "fetch_messages":
-                asyncio.create_task(self.get_room_messages(page=content["page"]))
+                self.create_command_task(
+                    command, self.get_room_messages(page=content["page"])
+                )
+            if content.get("command") == "sync_messages":
+                self.create_command_task(command, self.sync_messages(content))
             if content.get("command") == "fetch_messages_up_to_page":
-                asyncio.create_task(
-                    self.get_room_messages_up_to_page(page=content["page"])
+                self.create_command_task(
+                    command, self.get_room_messages_up_to_page(page=content["page"])
                 )
             if content.get("command") == "fetch_display_name":
-                asyncio.create_task(self.fetch_display_name())
+                self.create_command_task(command, self.fetch_display_name())
             if content.get("command") == "fetch_upload_url":
-                asyncio.create_task(self.fetch_upload_url())
+                self.create_command_task(command, self.fetch_upload_url())
             if content.get("command") == "read_room_notification":
-                asyncio.create_task(self.read_room_notification())
+                self.create_command_task(command, self.read_room_notification())
             if content.get("command") == "edit_message":
-                asyncio.create_task(self.edit_message(content))
-
-    async def fetch_recording_settings(self):
-        recording_settings = await database_sync_to_async(self.get_recording_settings)()
-        language_name = "Not Found"
-        for language in LANGUAGES:
-            if language[1] == recording_settings.language:
-                language_name = language[0]
-        if language_name == "Not Found":
-            logger.error(
-                f"Could not find language name for language {recording_settings.language} in recording settings for "
-                f"user {recording_settings.user} in room {recording_settings.room}"
-            )
-        await self.channel_layer.send(
-            self.channel_name,
-            {
-                "type": "recording_settings",
-                "language_name": language_name,
-                "voice_effect": recording_settings.voice_effect,
-            },
-        )
+                self.create_command_task(command, self.edit_message(content))
+            if content.get("command") == "fetch_download_urls":
+                self.create_command_task(command, self.fetch_download_urls(content))
 
     async def change_voice_effect(self, input_payload):
         new_voice_effect = input_payload.get("voice_effect")
@@ -408,25 +836,43 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def edit_message(self, payload):
-        users_to_refresh = await database_sync_to_async(self.edit_message_content)(
-            payload["message_id"], payload["edited_message"]
+        try:
+            message_id = str(uuid.UUID(str(payload.get("message_id"))))
+        except ValueError:
+            return
+        content = payload["edited_message"]
+        edited_at, usernames = await database_sync_to_async(self.edit_message_content)(
+            message_id, content
         )
-        await self.channel_layer.group_send(
+        if edited_at is None:
+            return
+        await publish_room_event(
+            self.channel_layer,
             self.room_id,
             {
-                "type": "refresh_messages",
+                "type": "message_edited",
+                "id": message_id,
+                "content": content,
+                "edited_at": edited_at,
             },
         )
-        for username in users_to_refresh:
-            await self.channel_layer.group_send(
-                username,
-                {
-                    "type": "refresh_notifications",
-                },
+        # Only inboxes showing this message as their room's latest change.
+        await asyncio.gather(
+            *(
+                self.channel_layer.group_send(
+                    username,
+                    {
+                        "type": "notification_edited",
+                        "room": self.room_id,
+                        "message__content": content,
+                    },
+                )
+                for username in usernames
             )
+        )
 
     async def read_room_notification(self):
-        await database_sync_to_async(self.read_unread_room_notification)()
+        await self.mark_room_notification_read()
         await self.channel_layer.group_send(
             self.user.username,
             {
@@ -436,23 +882,67 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
 
     async def fetch_upload_url(self):
         filename = str(uuid.uuid4())
-        url = generate_upload_signed_url_v4(filename)
         dry_filename = "dry-" + filename
-        dry_url = generate_upload_signed_url_v4(dry_filename)
+        urls = await sync_to_async(self.sign_upload_urls, thread_sensitive=False)(
+            [filename, dry_filename]
+        )
         await self.channel_layer.send(
             self.channel_name,
             {
                 "type": "upload_url",
-                "dry_upload_url": dry_url,
+                "dry_upload_url": urls[dry_filename],
                 "dry_filename": dry_filename,
-                "wet_upload_url": url,
+                "wet_upload_url": urls[filename],
                 "wet_filename": filename,
             },
         )
 
+    async def fetch_download_urls(self, input_payload):
+        requested = input_payload.get("filenames")
+        filenames = set()
+        if isinstance(requested, list):
+            for filename in requested[:DOWNLOAD_URL_BATCH_SIZE]:
+                try:
+                    filenames.add(str(uuid.UUID(str(filename))))
+                except ValueError:
+                    pass
+        playable = []
+        if filenames:
+            playable = await database_sync_to_async(
+                self.get_playable_filenames, read_only=True
+            )(filenames)
+        cached_urls = cache.get_many(
+            [f"download_url:{filename}" for filename in playable]
+        )
+        download_urls = {}
+        unsigned = []
+        for filename in playable:
+            url = cached_urls.get(f"download_url:{filename}")
+            if url:
+                metrics.cache_requests.inc(cache="download_url", result="hit")
+                download_urls[filename] = url
+            else:
+                metrics.cache_requests.inc(cache="download_url", result="miss")
+                unsigned.append(filename)
+        if unsigned:
+            # Signing is CPU bound, so a batch of misses runs in a worker
+            # thread rather than stalling every connection on the loop.
+            new_urls = await sync_to_async(
+                self.sign_download_urls, thread_sensitive=False
+            )(unsigned)
+            download_urls.update(new_urls)
+            cache.set_many(
+                {f"download_url:{filename}": url for filename, url in new_urls.items()},
+                timeout=DOWNLOAD_URL_CACHE_TIMEOUT,
+            )
+        await self.channel_layer.send(
+            self.channel_name,
+            {"type": "download_urls", "download_urls": download_urls},
+        )
+
     async def get_room_messages_up_to_page(self, *, page):
         messages, page_number = await database_sync_to_async(
-            self.fetch_messages_up_to_page
+            self.fetch_messages_up_to_page, read_only=True, lane="bulk"
         )(page=page)
         if messages:
             await self.channel_layer.send(
@@ -461,29 +951,135 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
                     "type": "messages",
                     "messages": messages,
                     "page": page_number,
-                    "refresh_messages_in": 604790000,
                 },
             )
 
     async def get_room_messages(self, *, page):
-        messages, page_number = await database_sync_to_async(self.fetch_messages)(
-            page=page
-        )
+        messages, page_number = await database_sync_to_async(
+            self.fetch_messages, read_only=True
+        )(page=page)
         await self.channel_layer.send(
             self.channel_name,
             {"type": "messages", "messages": messages, "page": page_number},
         )
 
+    async def sync_messages(self, input_payload):
+        messages, edited, complete = [], [], False
+        held_ids = input_payload.get("ids")
+        try:
+            newest_id = uuid.UUID(str(input_payload.get("newest_id")))
+            if held_ids is not None:
+                if not isinstance(held_ids, list) or len(held_ids) > SYNC_IDS_LIMIT:
+                    raise ValueError("Invalid held message ids")
+                held_ids = [uuid.UUID(str(message_id)) for message_id in held_ids]
+            valid_payload = True
+        except (TypeError, ValueError):
+            valid_payload = False
+        if valid_payload:
+            messages, edited, complete = await database_sync_to_async(
+                self.sync_messages_since, read_only=True
+            )(newest_id, held_ids)
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                "type": "messages_synced",
+                "messages": messages,
+                "edited": edited,
+                "complete": complete,
+            },
+        )
+
+    def message_key_cache_key(self, message_key):
+        return f"send_message:{self.user.username}:{self.room_id}:{message_key}"
+
     async def send_message(self, input_payload):
-        new_message = None
+        message_key = input_payload.get("message_key")
+        if (
+            not isinstance(message_key, str)
+            or not message_key
+            or len(message_key) > MESSAGE_KEY_MAX_LENGTH
+        ):
+            message_key = None
+        if message_key:
+            cache_key = self.message_key_cache_key(message_key)
+            if not cache.add(
+                cache_key, MESSAGE_KEY_PENDING, timeout=MESSAGE_KEY_CACHE_TIMEOUT
+            ):
+                metrics.cache_requests.inc(cache="message_key", result="hit")
+                cached_message = cache.get(cache_key)
+                if cached_message == MESSAGE_KEY_PENDING:
+                    await self.channel_layer.send(
+                        self.channel_name,
+                        {"type": "message_pending", "message_key": message_key},
+                    )
+                elif cached_message:
+                    await self.channel_layer.send(
+                        self.channel_name,
+                        {"type": "new_message", "new_message": cached_message},
+                    )
+                return
+            metrics.cache_requests.inc(cache="message_key", result="miss")
+            existing_message = await database_sync_to_async(self.get_message_by_key)(
+                message_key
+            )
+            if existing_message:
+                cache.set(
+                    cache_key, existing_message, timeout=MESSAGE_KEY_CACHE_TIMEOUT
+                )
+                await self.channel_layer.send(
+                    self.channel_name,
+                    {"type": "new_message", "new_message": existing_message},
+                )
+                return
+        try:
+            new_message, created = await self.create_message_from_payload(
+                input_payload, message_key
+            )
+        except Exception:
+            if message_key:
+                cache.delete(self.message_key_cache_key(message_key))
+            raise
+        if message_key:
+            if new_message:
+                cache.set(
+                    self.message_key_cache_key(message_key),
+                    new_message,
+                    timeout=MESSAGE_KEY_CACHE_TIMEOUT,
+                )
+            else:
+                cache.delete(self.message_key_cache_key(message_key))
+        if new_message and not created:
+            await self.channel_layer.send(
+                self.channel_name,
+                {"type": "new_message", "new_message": new_message},
+            )
+        elif new_message:
+            await publish_room_event(
+                self.channel_layer,
+                self.room_id,
+                {"type": "new_message", "new_message": new_message},
+            )
+            await self.channel_layer.group_send(
+                room_inbox_group(self.room_id),
+                {
+                    "type": "refresh_notifications",
+                },
+            )
+            await self.channel_layer.group_send(
+                self.room_id,
+                {"type": "room_notified"},
+            )
+
+    async def create_message_from_payload(self, input_payload, message_key):
         message = input_payload.get("message", "")
         dry_filename = input_payload.get("dry_filename")
         wet_filename = input_payload.get("wet_filename")
         if isinstance(dry_filename, str) and isinstance(wet_filename, str):
-            source = {"url": generate_download_signed_url_v4(dry_filename)}
-            recording_settings = await database_sync_to_async(
-                self.get_recording_settings
-            )()
+            urls = await sync_to_async(self.sign_download_urls, thread_sensitive=False)(
+                [dry_filename]
+            )
+            source = {"url": urls[dry_filename]}
+            recording_settings = await self.load_recording_settings()
             options = {
                 "punctuate": True,
                 "model": "general",
@@ -492,56 +1088,45 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
                 if recording_settings.base_only_language()
                 else "enhanced",
             }
+            started_at = time.perf_counter()
             try:
-                response = await DEEPGRAM_CLIENT.transcription.prerecorded(
-                    source, options
-                )
+                with tracing.span(
+                    "deepgram.transcription",
+                    language=options["language"],
+                    tier=options["tier"],
+                ):
+                    response = await DEEPGRAM_CLIENT.transcription.prerecorded(
+                        source, options
+                    )
             except Exception as error:
+                metrics.transcription_duration.observe(
+                    time.perf_counter() - started_at, outcome="error"
+                )
                 logger.error(
                     f"When attempting transcription, message with filename {dry_filename} generated {error}"
                 )
-                return
+                return None, False
+            metrics.transcription_duration.observe(
+                time.perf_counter() - started_at, outcome="success"
+            )
             transcript = response["results"]["channels"][0]["alternatives"][0][
                 "transcript"
             ]
-            new_message = await database_sync_to_async(self.create_new_message)(
-                transcript, wet_filename
-            )
+            return await self.save_new_message(transcript, wet_filename, message_key)
         elif len(message.strip()) > 0:
-            new_message = await database_sync_to_async(self.create_new_message)(
-                message, None
-            )
-        if new_message:
-            await self.channel_layer.group_send(
-                self.room_id,
-                {"type": "new_message", "new_message": new_message},
-            )
-            (
-                room_member_display_names,
-                room_member_usernames,
-            ) = await database_sync_to_async(self.get_all_room_members)()
-            for username in room_member_usernames:
-                await self.channel_layer.group_send(
-                    username,
-                    {
-                        "type": "refresh_notifications",
-                    },
-                )
-            await self.channel_layer.group_send(
-                self.room_id,
-                {"type": "room_notified"},
-            )
+            return await self.save_new_message(message, None, message_key)
+        return None, False
 
     async def update_display_name(self, input_payload):
         if len(input_payload["name"].strip()) > 0:
-            display_name, users_to_refresh = await database_sync_to_async(
-                self.change_display_name
-            )(input_payload["name"])
-            for username in users_to_refresh:
-                await self.channel_layer.group_send(
-                    username, {"type": "refresh_notifications"}
-                )
+            display_name = await database_sync_to_async(self.change_display_name)(
+                input_payload["name"]
+            )
             await self.channel_layer.group_send(
+                room_inbox_group(self.room_id), {"type": "refresh_notifications"}
+            )
+            await publish_room_event(
+                self.channel_layer,
                 self.room_id,
                 {
                     "type": "display_name",
@@ -560,13 +1145,13 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def approve_all_users(self):
-        added_usernames = await database_sync_to_async(self.approve_all_room_members)()
-        for username in added_usernames:
+        added_members = await database_sync_to_async(
+            self.approve_all_room_members, lane="bulk"
+        )()
+        for username in (member["username"] for member in added_members):
             await self.channel_layer.group_send(
                 username,
-                {
-                    "type": "refresh_notifications",
-                },
+                {"type": "subscribe_inbox", "room": self.room_id},
             )
             await self.channel_layer.group_send(
                 self.room_id,
@@ -580,10 +1165,12 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             self.room_id,
             {"type": "refresh_join_requests"},
         )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_members"},
-        )
+        if added_members:
+            await publish_room_event(
+                self.channel_layer,
+                self.room_id,
+                {"type": "member_added", "members": added_members},
+            )
         await self.channel_layer.group_send(
             self.room_id,
             {"type": "refresh_allowed_status"},
@@ -610,14 +1197,12 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             )
 
     async def approve_user(self, input_payload):
-        await database_sync_to_async(self.approve_room_member)(
+        member = await database_sync_to_async(self.approve_room_member)(
             input_payload["username"]
         )
         await self.channel_layer.group_send(
             input_payload["username"],
-            {
-                "type": "refresh_notifications",
-            },
+            {"type": "subscribe_inbox", "room": self.room_id},
         )
 
         await self.channel_layer.group_send(
@@ -632,9 +1217,10 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             self.room_id,
             {"type": "refresh_join_requests"},
         )
-        await self.channel_layer.group_send(
+        await publish_room_event(
+            self.channel_layer,
             self.room_id,
-            {"type": "refresh_members"},
+            {"type": "member_added", "members": [member]},
         )
         await self.channel_layer.group_send(
             self.room_id,
@@ -657,20 +1243,44 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def fetch_members(self):
-        member_display_names, member_usernames = await database_sync_to_async(
-            self.get_all_room_members
+        member_display_names = await database_sync_to_async(
+            self.get_all_room_members, read_only=True
         )()
         await self.channel_layer.send(
             self.channel_name,
             {"type": "members", "members": member_display_names},
         )
         room = await database_sync_to_async(self.get_room)(self.room_id)
-        if self.user.username not in member_usernames and not room.private:
+        is_member = await database_sync_to_async(self.is_room_member)()
+        if not is_member and not room.private:
             await self.channel_layer.send(
                 self.channel_name,
                 {"type": "left_room", "room": str(room.id)},
             )
 
+    async def fetch_roster(self, input_payload):
+        cursor = input_payload.get("cursor")
+        try:
+            after = decode_roster_cursor(cursor) if cursor else None
+        except (TypeError, ValueError):
+            await self.channel_layer.send(
+                self.channel_name,
+                {"type": "roster", "cursor": cursor, "error": "invalid_cursor"},
+            )
+            return
+        members, next_cursor = await database_sync_to_async(
+            self.get_roster_page, read_only=True
+        )(after)
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                "type": "roster",
+                "cursor": cursor,
+                "members": members,
+                "next_cursor": next_cursor,
+            },
+        )
+
     async def fetch_privacy(self):
         room = await database_sync_to_async(self.get_room)(self.room_id)
         await self.channel_layer.send(
@@ -679,7 +1289,9 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def fetch_join_requests(self):
-        all_join_requests = await database_sync_to_async(self.get_all_join_requests)()
+        all_join_requests = await database_sync_to_async(
+            self.get_all_join_requests, read_only=True
+        )()
         await self.channel_layer.send(
             self.channel_name,
             {"type": "join_requests", "join_requests": all_join_requests},
@@ -687,9 +1299,10 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
 
     async def update_privacy(self, input_payload):
         await database_sync_to_async(self.set_room_privacy)(input_payload["privacy"])
-        await self.channel_layer.group_send(
+        await publish_room_event(
+            self.channel_layer,
             self.room_id,
-            {"type": "refresh_privacy"},
+            {"type": "refresh_privacy", "privacy": input_payload["privacy"]},
         )
 
     async def upload_url(self, event):
@@ -700,7 +1313,42 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         # Send message to WebSocket
         await self.send_json(event)
 
+    async def room_bootstrap(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def room_resumed(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def messages_synced(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
     async def new_message(self, event):
+        self.room_state["seen_message_id"] = event["new_message"]["id"]
+        await self.send_json(event)
+
+    async def message_pending(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def message_edited(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def profile_updated(self, event):
+        # Another connection of the same user renamed them, and new messages
+        # are stamped with the display name held here.
+        if event["username"] == self.user.username:
+            self.user.display_name = event["display_name"]
+        await self.send_json(event)
+
+    async def download_urls(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def presence(self, event):
         # Send message to WebSocket
         await self.send_json(event)
 
@@ -739,9 +1387,28 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def refresh_members(self, event):
+        # Only sent by processes still running the code from before
+        # member_added and member_removed. Remove once they're all gone.
+        self.invalidate_room_state("room", "is_member")
+        await self.send_json(event)
+
+    async def roster(self, event):
         # Send message to WebSocket
         await self.send_json(event)
 
+    async def member_added(self, event):
+        if any(member["username"] == self.user.username for member in event["members"]):
+            self.invalidate_room_state("is_member")
+        await self.send_json(event)
+
+    async def member_removed(self, event):
+        # The last member leaving deletes the room, so the row goes too.
+        if event["username"] == self.user.username:
+            self.invalidate_room_state("room", "is_member")
+        else:
+            self.invalidate_room_state("room")
+        await self.send_json(event)
+
     async def allowed(self, event):
         # Send message to WebSocket
         await self.send_json(event)
@@ -751,11 +1418,11 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def recording_settings(self, event):
-        # Send message to WebSocket
+        self.invalidate_room_state("recording_settings")
         await self.send_json(event)
 
     async def refresh_privacy(self, event):
-        # Send message to WebSocket
+        self.invalidate_room_state("room")
         await self.send_json(event)
 
     async def privacy(self, event):
@@ -767,11 +1434,17 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def display_name(self, event):
-        # Send message to WebSocket
+        room = self.room_state.get("room")
+        if room is not None:
+            room.display_name = event["display_name"]
         await self.send_json(event)
 
 
-class UserConsumer(AsyncJsonWebsocketConsumer):
+class UserConsumer(
+    InstrumentedConsumerMixin, CodecConsumerMixin, AsyncJsonWebsocketConsumer
+):
+    consumer_label = "user"
+
     def get_user_notifications(self):
         notifications = list(
             self.user.notification_set.values(
@@ -779,6 +1452,7 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
                 "room__display_name",
                 "read",
                 "timestamp",
+                "message",
                 "message__creator__display_name",
                 "message__content",
             )
@@ -787,11 +1461,6 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
         )
         notifications.sort(key=itemgetter("timestamp"), reverse=True)
         notifications.sort(key=itemgetter("read"))
-        for notification in notifications:
-            notification["room"] = str(notification["room"])
-            notification["timestamp"] = notification["timestamp"].strftime(
-                "%d-%m-%Y %H:%M"
-            )
         return notifications
 
     def leave_room(self, room_id):
@@ -802,77 +1471,159 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
         if not room_to_leave.members.all() and not room_to_leave.joinrequest_set.all():
             room_to_leave.delete()
 
+    def search_room_messages(self, query, position):
+        messages = Message.objects.filter(room__in=self.user.room_set.values("id"))
+        if connection.vendor == "postgresql":
+            search_query = SearchQuery(query, config="simple", search_type="websearch")
+            messages = messages.filter(search_vector=search_query).annotate(
+                rank=Cast(SearchRank(F("search_vector"), search_query), FloatField())
+            )
+        else:
+            messages = messages.filter(content__icontains=query).annotate(
+                rank=Value(0.0, output_field=FloatField())
+            )
+        if position:
+            rank, created_at, message_id = position
+            messages = messages.filter(
+                Q(rank__lt=rank)
+                | Q(rank=rank, created_at__lt=created_at)
+                | Q(rank=rank, created_at=created_at, id__lt=message_id)
+            )
+        hits = list(
+            messages.order_by("-rank", "-created_at", "-id").values(
+                "id",
+                "room",
+                "room__display_name",
+                "content",
+                "creator__display_name",
+                "creator__username",
+                "created_at",
+                "filename",
+                "rank",
+            )[: SEARCH_PAGE_SIZE + 1]
+        )
+        next_cursor = None
+        if len(hits) > SEARCH_PAGE_SIZE:
+            hits = hits[:SEARCH_PAGE_SIZE]
+            next_cursor = encode_search_cursor(hits[-1])
+        return hits, next_cursor
+
+    def get_room_ids(self):
+        return [
+            str(room_id) for room_id in self.user.room_set.values_list("id", flat=True)
+        ]
+
     def change_display_name(self, new_name):
         self.user.display_name = new_name
         self.user.save()
-        rooms_to_refresh = [
-            str(room["id"]) for room in self.user.room_set.all().values()
-        ] + [
-            str(request["room_id"])
-            for request in self.user.joinrequest_set.all().values()
-        ]
-        rooms_to_refresh = set(rooms_to_refresh)
-        users_to_refresh = [
-            str(notification["user__username"])
-            for notification in Notification.objects.filter(
-                message__creator=self.user
-            ).values("user__username")
-        ]
-        return new_name, rooms_to_refresh, users_to_refresh
+        # Every room that can show this user: as a member, a join request or
+        # the creator of a message someone's notification points at.
+        room_ids = (
+            self.user.room_set.values_list("id", flat=True)
+            .union(
+                self.user.joinrequest_set.values_list("room_id", flat=True),
+                Notification.objects.filter(message__creator=self.user).values_list(
+                    "room_id", flat=True
+                ),
+            )
+            .order_by()
+        )
+        return new_name, {str(room_id) for room_id in room_ids}
 
     async def connect(self):
         self.username = str(self.scope["url_route"]["kwargs"]["user_id"])
         self.user = self.scope["user"]
         if self.username == self.user.username:
             await self.channel_layer.group_add(self.username, self.channel_name)
+            self.inbox_rooms = set()
+            readstate.start(self.channel_layer)
             await self.accept()
-
-            notifications = await database_sync_to_async(self.get_user_notifications)()
-            await self.channel_layer.group_send(
-                self.username,
-                {
-                    "type": "notifications",
-                    "notifications": notifications,
-                },
-            )
-            await self.fetch_display_name()
+            await self.observe_command("connect", self.initialize_user())
         else:
             await self.close()
 
+    async def initialize_user(self):
+        room_ids = await database_sync_to_async(self.get_room_ids)()
+        await asyncio.gather(*(self.join_inbox(room_id) for room_id in room_ids))
+        notifications = await self.load_notifications()
+        await self.channel_layer.group_send(
+            self.username,
+            {
+                "type": "notifications",
+                "notifications": notifications,
+            },
+        )
+        await self.fetch_display_name()
+
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.username, self.channel_name)
+        for room_id in getattr(self, "inbox_rooms", ()):
+            await self.channel_layer.group_discard(
+                room_inbox_group(room_id), self.channel_name
+            )
 
     async def receive_json(self, content, **kwargs):
+        command = content.get("command")
         if self.username == self.user.username:
             if content.get("command") == "exit_room":
-                asyncio.create_task(self.exit_room(content))
+                self.create_command_task(command, self.exit_room(content))
             if content.get("command") == "fetch_notifications":
-                asyncio.create_task(self.fetch_notifications())
+                self.create_command_task(command, self.fetch_notifications())
             if content.get("command") == "update_display_name":
-                asyncio.create_task(self.update_display_name(content))
+                self.create_command_task(command, self.update_display_name(content))
+            if content.get("command") == "search_messages":
+                self.create_command_task(command, self.search_messages(content))
+
+    async def search_messages(self, input_payload):
+        query = input_payload.get("query")
+        cursor = input_payload.get("cursor")
+        try:
+            position = decode_search_cursor(cursor) if cursor else None
+        except (TypeError, ValueError):
+            await self.channel_layer.send(
+                self.channel_name,
+                {
+                    "type": "search_results",
+                    "query": query,
+                    "cursor": cursor,
+                    "error": "invalid_cursor",
+                },
+            )
+            return
+        results, next_cursor = [], None
+        if isinstance(query, str) and query.strip():
+            results, next_cursor = await database_sync_to_async(
+                self.search_room_messages, read_only=True, lane="bulk"
+            )(query.strip()[:SEARCH_QUERY_MAX_LENGTH], position)
+        await self.channel_layer.send(
+            self.channel_name,
+            {
+                "type": "search_results",
+                "query": query,
+                "cursor": cursor,
+                "results": results,
+                "next_cursor": next_cursor,
+            },
+        )
 
     async def update_display_name(self, input_payload):
         if len(input_payload["name"].strip()) > 0:
-            (
-                display_name,
-                rooms_to_refresh,
-                users_to_refresh,
-            ) = await database_sync_to_async(self.change_display_name)(
-                input_payload["name"]
+            display_name, room_ids = await database_sync_to_async(
+                self.change_display_name, lane="bulk"
+            )(input_payload["name"])
+            await layers.group_send_many(
+                self.channel_layer,
+                [
+                    group
+                    for room_id in sorted(room_ids)
+                    for group in (room_id, room_inbox_group(room_id))
+                ],
+                {
+                    "type": "profile_updated",
+                    "username": self.username,
+                    "display_name": display_name,
+                },
             )
-            for room in rooms_to_refresh:
-                await self.channel_layer.group_send(room, {"type": "refresh_members"})
-                await self.channel_layer.group_send(
-                    room, {"type": "refresh_join_requests"}
-                )
-                await self.channel_layer.group_send(room, {"type": "refresh_messages"})
-            for username in users_to_refresh:
-                await self.channel_layer.group_send(
-                    username,
-                    {
-                        "type": "refresh_notifications",
-                    },
-                )
             await self.channel_layer.group_send(
                 self.username,
                 {
@@ -890,8 +1641,16 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
             {"type": "display_name", "display_name": display_name},
         )
 
+    async def load_notifications(self):
+        notifications = await database_sync_to_async(
+            self.get_user_notifications, read_only=True
+        )()
+        return await readstate.apply_pending(
+            self.channel_layer, self.user.id, notifications
+        )
+
     async def fetch_notifications(self):
-        notifications = await database_sync_to_async(self.get_user_notifications)()
+        notifications = await self.load_notifications()
         await self.channel_layer.group_send(
             self.username,
             {
@@ -903,14 +1662,19 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
     async def exit_room(self, input_payload):
         await database_sync_to_async(self.leave_room)(input_payload["room_id"])
         await self.channel_layer.group_send(
+            self.username,
+            {"type": "unsubscribe_inbox", "room": input_payload["room_id"]},
+        )
+        await publish_room_event(
+            self.channel_layer,
             input_payload["room_id"],
-            {"type": "refresh_members"},
+            {"type": "member_removed", "username": self.username},
         )
         await self.channel_layer.group_send(
             input_payload["room_id"],
             {"type": "refresh_allowed_status"},
         )
-        notifications = await database_sync_to_async(self.get_user_notifications)()
+        notifications = await self.load_notifications()
         await self.channel_layer.group_send(
             self.username,
             {
@@ -919,14 +1683,182 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
             },
         )
 
+    async def join_inbox(self, room_id):
+        if room_id not in self.inbox_rooms:
+            self.inbox_rooms.add(room_id)
+            await self.channel_layer.group_add(
+                room_inbox_group(room_id), self.channel_name
+            )
+
+    async def subscribe_inbox(self, event):
+        await self.join_inbox(event["room"])
+        await self.send_json({"type": "refresh_notifications"})
+
+    async def unsubscribe_inbox(self, event):
+        self.inbox_rooms.discard(event["room"])
+        await self.channel_layer.group_discard(
+            room_inbox_group(event["room"]), self.channel_name
+        )
+
     async def notifications(self, event):
         # Send message to WebSocket
         await self.send_json(event)
 
+    async def search_results(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
     async def refresh_notifications(self, event):
         # Send message to WebSocket
         await self.send_json(event)
 
+    async def notification_edited(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
+
+    async def profile_updated(self, event):
+        if event["username"] == self.user.username:
+            self.user.display_name = event["display_name"]
+        await self.send_json(event)
+
     async def display_name(self, event):
         # Send message to WebSocket
         await self.send_json(event)
+
+
+class StreamMixin:
+    # A room or inbox consumer running inside a MultiplexConsumer: it keeps its
+    # own channel name and groups, but frames go out over the shared socket.
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code=None):
+        await self.multiplexer.close_stream(self.stream)
+
+    async def send_json(self, content, close=False):
+        await self.multiplexer.send_json({"stream": self.stream, "payload": content})
+
+
+class RoomStream(StreamMixin, RoomConsumer):
+    pass
+
+
+class InboxStream(StreamMixin, UserConsumer):
+    pass
+
+
+class MultiplexConsumer(
+    InstrumentedConsumerMixin, CodecConsumerMixin, AsyncJsonWebsocketConsumer
+):
+    consumer_label = "multiplex"
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.streams = collections.OrderedDict()
+        self.stream_tasks = {}
+        await self.accept()
+        inbox = await self.open_stream(
+            "inbox", InboxStream, {"user_id": self.user.username}
+        )
+        await inbox.connect()
+
+    async def disconnect(self, close_code):
+        for stream in list(self.streams):
+            await self.close_stream(stream)
+
+    async def open_stream(self, stream, consumer_class, url_kwargs):
+        consumer = consumer_class()
+        consumer.scope = {**self.scope, "url_route": {"args": (), "kwargs": url_kwargs}}
+        consumer.channel_layer = self.channel_layer
+        consumer.channel_name = await self.channel_layer.new_channel()
+        consumer.multiplexer = self
+        consumer.database_lock = self.database_lock
+        consumer.stream = stream
+        self.streams[stream] = consumer
+        self.stream_tasks[stream] = asyncio.create_task(
+            self.run_stream(stream, consumer)
+        )
+        return consumer
+
+    async def run_stream(self, stream, consumer):
+        try:
+            while True:
+                message = await self.channel_layer.receive(consumer.channel_name)
+                await consumer.dispatch(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self.fail_stream(stream)
+
+    async def receive_stream(self, stream, consumer, payload):
+        try:
+            await consumer.receive_json(payload)
+        except Exception:
+            await self.fail_stream(stream)
+
+    async def fail_stream(self, stream):
+        # Only the stream that failed is closed, the socket and the other
+        # streams carry on.
+        logger.exception(f"Stream {stream} for user {self.user} failed")
+        consumer = self.streams.pop(stream, None)
+        task = self.stream_tasks.pop(stream, None)
+        if consumer is None:
+            return
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        await consumer.disconnect(1011)
+        await self.send_json({"stream": stream, "payload": {"type": "closed"}})
+
+    async def close_stream(self, stream):
+        consumer = self.streams.pop(stream, None)
+        task = self.stream_tasks.pop(stream, None)
+        if consumer is None:
+            return
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        await consumer.disconnect(1000)
+
+    async def open_room_stream(self, stream, room_id):
+        room_streams = [key for key in self.streams if key != "inbox"]
+        while len(room_streams) >= MULTIPLEX_MAX_ROOM_STREAMS:
+            evicted = room_streams.pop(0)
+            await self.close_stream(evicted)
+            await self.send_json({"stream": evicted, "payload": {"type": "closed"}})
+        room = await self.open_stream(stream, RoomStream, {})
+        room.room_id = room_id
+        await room.connect()
+        return room
+
+    async def receive_json(self, content, **kwargs):
+        stream = content.get("stream")
+        payload = content.get("payload")
+        if not isinstance(stream, str) or not isinstance(payload, dict):
+            return
+        if stream == "inbox":
+            inbox = self.streams.get("inbox")
+            if inbox is not None:
+                await self.receive_stream(stream, inbox, payload)
+            return
+        if not stream.startswith("room:"):
+            return
+        room_id = stream[len("room:") :]
+        try:
+            uuid.UUID(room_id)
+        except ValueError:
+            return
+        if payload.get("command") == "disconnect":
+            await self.close_stream(stream)
+            return
+        room = self.streams.get(stream)
+        if payload.get("command") == "connect":
+            if room is None:
+                try:
+                    room = await self.open_room_stream(stream, room_id)
+                except Exception:
+                    await self.fail_stream(stream)
+                    return
+            payload = {**payload, "room": room_id}
+        if room is not None:
+            self.streams.move_to_end(stream)
+            await self.receive_stream(stream, room, payload)
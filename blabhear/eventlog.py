@@ -0,0 +1,144 @@
+import collections
+import time
+
+import msgpack
+
+from blabhear import metrics
+from blabhear.codecs import encode_default
+
+EVENT_LOG_LENGTH = 500
+EVENT_LOG_TTL = 60 * 60
+
+
+class MemoryEventLog:
+    # Mirrors the Redis log: about the last EVENT_LOG_LENGTH events per room,
+    # and a room's events and counter are dropped EVENT_LOG_TTL after its last
+    # event, so its numbering restarts and resumes fall back to a bootstrap.
+
+    sweep_interval = 60
+
+    def __init__(self):
+        self.rooms = {}
+        self.last_sweep = time.monotonic()
+
+    def get_room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is not None and time.monotonic() - room["appended_at"] > EVENT_LOG_TTL:
+            del self.rooms[room_id]
+            return None
+        return room
+
+    def sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for room_id in list(self.rooms):
+            if now - self.rooms[room_id]["appended_at"] > EVENT_LOG_TTL:
+                del self.rooms[room_id]
+
+    async def append(self, room_id, event):
+        self.sweep()
+        room = self.get_room(room_id)
+        if room is None:
+            room = self.rooms[room_id] = {
+                "seq": 0,
+                "events": collections.deque(maxlen=EVENT_LOG_LENGTH),
+            }
+        room["seq"] += 1
+        room["appended_at"] = time.monotonic()
+        room["events"].append({**event, "seq": room["seq"]})
+        return room["seq"]
+
+    async def latest(self, room_id):
+        room = self.get_room(room_id)
+        return room["seq"] if room is not None else 0
+
+    async def since(self, room_id, seq):
+        room = self.get_room(room_id) or {"seq": 0, "events": ()}
+        return room["seq"], [
+            dict(event) for event in room["events"] if event["seq"] > seq
+        ]
+
+
+class RedisEventLog:
+    # One stream per room whose entry ids are the room's sequence numbers, so
+    # a client's last seen number is also where to resume reading. The
+    # counter and the stream share a shard and are bumped in one script.
+
+    append_lua = """
+        local seq = redis.call('INCR', KEYS[2])
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'event', ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        return seq
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def connection(self, room_id):
+        return self.channel_layer.connection(
+            self.channel_layer.consistent_hash(room_id)
+        )
+
+    async def append(self, room_id, event):
+        packed = msgpack.packb(event, default=encode_default, use_bin_type=True)
+        async with self.connection(room_id) as connection:
+            return await connection.eval(
+                self.append_lua,
+                keys=[f"blabhear:events:{room_id}", f"blabhear:events:{room_id}:seq"],
+                args=[packed, EVENT_LOG_LENGTH, EVENT_LOG_TTL],
+            )
+
+    async def latest(self, room_id):
+        async with self.connection(room_id) as connection:
+            seq = await connection.get(f"blabhear:events:{room_id}:seq")
+        return int(seq or 0)
+
+    async def since(self, room_id, seq):
+        async with self.connection(room_id) as connection:
+            transaction = connection.multi_exec()
+            transaction.get(f"blabhear:events:{room_id}:seq")
+            transaction.xrange(f"blabhear:events:{room_id}", start=f"{seq + 1}-0")
+            latest, entries = await transaction.execute()
+        events = []
+        for entry_id, fields in entries:
+            event = msgpack.unpackb(fields[b"event"], raw=False)
+            event["seq"] = int(entry_id.split(b"-")[0])
+            events.append(event)
+        return int(latest or 0), events
+
+
+memory_log = MemoryEventLog()
+
+
+def get_log(channel_layer):
+    if hasattr(channel_layer, "connection") and hasattr(
+        channel_layer, "consistent_hash"
+    ):
+        return RedisEventLog(channel_layer)
+    return memory_log
+
+
+async def append(channel_layer, room_id, event):
+    seq = await get_log(channel_layer).append(str(room_id), event)
+    metrics.room_events.inc(result="logged")
+    return seq
+
+
+async def latest(channel_layer, room_id):
+    return await get_log(channel_layer).latest(str(room_id))
+
+
+async def missed(channel_layer, room_id, seq):
+    # The events after seq, or None when the log can no longer cover the gap
+    # because it was trimmed, expired or restarted its numbering.
+    latest_seq, events = await get_log(channel_layer).since(str(room_id), seq)
+    if seq > latest_seq or (
+        latest_seq > seq and (not events or events[0]["seq"] != seq + 1)
+    ):
+        metrics.room_events.inc(result="gap")
+        return None
+    metrics.room_events.inc(len(events), result="replayed")
+    return events
@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+
+from channels.db import DatabaseSyncToAsync
+from django.db import connections
+
+from blabhear import lanes, layers, loopmonitor, metrics, replicas, slowqueries, tracing
+from blabhear.exceptions import DatabaseLaneFull
+
+current_command = contextvars.ContextVar("current_command", default=None)
+
+
+def command_label():
+    return current_command.get() or "receive_json"
+
+
+class QueryObserver:
+    def __init__(self, command):
+        self.command = command
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            result = execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started_at
+            self.count += 1
+            metrics.db_queries.inc(command=self.command)
+            metrics.db_query_seconds.inc(duration, command=self.command)
+        if replicas.is_write(sql):
+            replicas.record_write()
+        if slowqueries.enabled():
+            slowqueries.record(self.command, sql, params, many, duration, context)
+        return result
+
+
+def database_sync_to_async(func, read_only=False, lane="interactive"):
+    name = getattr(func, "__name__", "call")
+    sync_calls = {}
+
+    def observed(db_lane, ticket, database, *args, **kwargs):
+        if not db_lane.start(ticket):
+            return None
+        try:
+            return observe_queries(database, *args, **kwargs)
+        finally:
+            db_lane.finish()
+
+    def observe_queries(database, *args, **kwargs):
+        observer = QueryObserver(command_label())
+        database_token = replicas.current_database.set(database)
+        try:
+            with contextlib.ExitStack() as stack:
+                for alias in {"default", database or "default"}:
+                    stack.enter_context(connections[alias].execute_wrapper(observer))
+                return func(*args, **kwargs)
+        finally:
+            replicas.current_database.reset(database_token)
+            tracing.set_attribute("db.queries", observer.count)
+
+    async def traced(*args, **kwargs):
+        database = replicas.read_database() if read_only else None
+        db_lane = lanes.get_lane(lane)
+        sync_call = sync_calls.get(db_lane)
+        if sync_call is None:
+            sync_call = sync_calls[db_lane] = DatabaseSyncToAsync(
+                observed, thread_sensitive=False, executor=db_lane.executor
+            )
+        # The helpers of one connection share its user, room state and cached
+        # models, so they run one at a time in the order they were called.
+        connection_lock = getattr(
+            getattr(func, "__self__", None), "database_lock", None
+        )
+        with tracing.span(f"db.{name}", database=database or "default", lane=lane):
+            async with connection_lock or contextlib.nullcontext():
+                ticket = db_lane.admit()
+                try:
+                    return await sync_call(db_lane, ticket, database, *args, **kwargs)
+                finally:
+                    db_lane.abandon(ticket)
+
+    return traced
+
+
+class InstrumentedChannelLayer:
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def __getattr__(self, name):
+        return getattr(self.channel_layer, name)
+
+    async def group_send(self, group, message):
+        # The hybrid layer counts the members it reads from Redis itself.
+        if not isinstance(self.channel_layer, layers.HybridRedisChannelLayer):
+            groups = getattr(self.channel_layer, "groups", {})
+            layers.count_recipients(len(groups.get(group, ())))
+        started_at = time.perf_counter()
+        try:
+            with tracing.span(
+                "channel_layer.group_send", group=group, type=message.get("type")
+            ):
+                return await self.channel_layer.group_send(group, message)
+        finally:
+            metrics.group_send_duration.observe(
+                time.perf_counter() - started_at, type=message.get("type")
+            )
+
+    async def group_send_many(self, groups, message):
+        started_at = time.perf_counter()
+        try:
+            with tracing.span(
+                "channel_layer.group_send_many",
+                groups=len(groups),
+                type=message.get("type"),
+            ):
+                return await layers.group_send_many(self.channel_layer, groups, message)
+        finally:
+            metrics.group_send_duration.observe(
+                time.perf_counter() - started_at, type=message.get("type")
+            )
+
+
+async def observe_command(consumer, command, coroutine):
+    command_token = current_command.set(command)
+    recipients = [0]
+    recipients_token = layers.current_recipients.set(recipients)
+    metrics.commands_in_flight.inc(consumer=consumer)
+    task = loopmonitor.track_command(consumer, command)
+    started_at = time.perf_counter()
+    try:
+        with tracing.span(f"{consumer}.{command}", consumer=consumer, command=command):
+            return await coroutine
+    finally:
+        loopmonitor.untrack_command(task)
+        metrics.commands_in_flight.dec(consumer=consumer)
+        metrics.command_duration.observe(
+            time.perf_counter() - started_at, consumer=consumer, command=command
+        )
+        metrics.group_send_recipients_per_command.observe(
+            recipients[0], command=command
+        )
+        current_command.reset(command_token)
+        layers.current_recipients.reset(recipients_token)
+
+
+class InstrumentedConsumerMixin:
+    consumer_label = None
+
+    async def websocket_connect(self, message):
+        loopmonitor.start()
+        replicas.start_session()
+        self.database_lock = asyncio.Lock()
+        if self.channel_layer is not None:
+            self.channel_layer = InstrumentedChannelLayer(self.channel_layer)
+        metrics.open_connections.inc(consumer=self.consumer_label)
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        metrics.open_connections.dec(consumer=self.consumer_label)
+        await super().websocket_disconnect(message)
+
+    def observe_command(self, command, coroutine):
+        return observe_command(
+            self.consumer_label, command, self.retry_when_busy(command, coroutine)
+        )
+
+    async def retry_when_busy(self, command, coroutine):
+        try:
+            return await coroutine
+        except DatabaseLaneFull:
+            await self.send_retry(command)
+
+    async def send_retry(self, command):
+        # The command was dropped before it touched the database, so the
+        # client can safely send it again.
+        await self.send_json({"type": "retry", "command": command})
+
+    def create_command_task(self, command, coroutine):
+        return asyncio.create_task(self.observe_command(command, coroutine))
+
+
+def observe_signing(method):
+    def decorator(func):
+        @functools.wraps(func)
+        def observed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                with tracing.span("storage.sign", method=method):
+                    return func(*args, **kwargs)
+            finally:
+                metrics.signing_duration.observe(
+                    time.perf_counter() - started_at, method=method
+                )
+
+        return observed
+
+    return decorator
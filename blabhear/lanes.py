@@ -0,0 +1,92 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from blabhear import metrics
+from blabhear.exceptions import DatabaseLaneFull
+
+QUEUED = "queued"
+RUNNING = "running"
+ABANDONED = "abandoned"
+
+
+class Ticket:
+    def __init__(self):
+        self.state = QUEUED
+        self.submitted_at = time.perf_counter()
+
+
+class Lane:
+    # A thread pool of its own for one class of database work, so slow bulk
+    # helpers queue behind each other instead of behind the membership checks.
+
+    def __init__(self, name, threads, queue_limit):
+        self.name = name
+        self.threads = threads
+        self.queue_limit = queue_limit
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix=f"db-{name}"
+        )
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        metrics.db_lane_threads.set(threads, lane=name)
+
+    def update_gauges(self):
+        metrics.db_lane_queued.set(self.queued, lane=self.name)
+        metrics.db_lane_running.set(self.running, lane=self.name)
+
+    def admit(self):
+        with self.lock:
+            if self.queued >= self.queue_limit:
+                metrics.db_lane_rejected.inc(lane=self.name)
+                raise DatabaseLaneFull(
+                    f"Database lane {self.name} has {self.queued} calls queued"
+                )
+            self.queued += 1
+            self.update_gauges()
+        return Ticket()
+
+    def start(self, ticket):
+        with self.lock:
+            if ticket.state == ABANDONED:
+                return False
+            ticket.state = RUNNING
+            self.queued -= 1
+            self.running += 1
+            self.update_gauges()
+        metrics.db_lane_wait_seconds.observe(
+            time.perf_counter() - ticket.submitted_at, lane=self.name
+        )
+        return True
+
+    def finish(self):
+        with self.lock:
+            self.running -= 1
+            self.update_gauges()
+
+    def abandon(self, ticket):
+        with self.lock:
+            if ticket.state == QUEUED:
+                ticket.state = ABANDONED
+                self.queued -= 1
+                self.update_gauges()
+
+
+lanes = {}
+lanes_lock = threading.Lock()
+
+
+def get_lane(name):
+    lane = lanes.get(name)
+    if lane is None:
+        with lanes_lock:
+            lane = lanes.get(name)
+            if lane is None:
+                config = settings.DATABASE_LANES[name]
+                lane = lanes[name] = Lane(
+                    name, config["threads"], config["queue_limit"]
+                )
+    return lane
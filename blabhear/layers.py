@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import contextvars
+import copy
+import logging
+import random
+import time
+
+import channels_redis
+import msgpack
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+from blabhear import metrics
+from blabhear.codecs import encode_default
+
+logger = logging.getLogger(__name__)
+
+# The hybrid layer overrides private RedisChannelLayer methods, so it only
+# works with the release those were written against.
+if not channels_redis.__version__.startswith("3.4."):
+    raise ImportError(
+        "HybridRedisChannelLayer needs channels_redis 3.4, "
+        f"found {channels_redis.__version__}"
+    )
+
+
+# Channels addressed by the group sends of the current command, for metrics.
+current_recipients = contextvars.ContextVar("current_recipients", default=None)
+
+
+def count_recipients(count):
+    recipients = current_recipients.get()
+    if recipients is not None:
+        recipients[0] += count
+
+
+class HybridRedisChannelLayer(RedisChannelLayer):
+    # Messages for channels owned by this process never touch Redis: sends and
+    # the local members of a group_send go straight into in-memory queues.
+    # Group membership still lives in Redis, and a single pump task per process
+    # moves messages that other processes addressed to us into the same queues.
+
+    sweep_interval = 30
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_queues = collections.defaultdict(collections.deque)
+        self.local_waiters = {}
+        self.pump_tasks = {}
+        self.last_sweep = time.monotonic()
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    def pack(self, message):
+        # Payloads carry datetimes and UUIDs that the consumers' codecs render.
+        # They're rendered once here, and every recipient unpacks its own copy,
+        # so local deliveries carry the same types as ones that crossed Redis.
+        return msgpack.packb(message, default=encode_default, use_bin_type=True)
+
+    def unpack(self, packed):
+        return msgpack.unpackb(packed, raw=False)
+
+    def deliver_locally(self, channel, message):
+        queue = self.local_queues[channel]
+        if len(queue) >= self.get_capacity(channel):
+            queue.popleft()
+            metrics.channel_layer_drops.inc(reason="evicted")
+        queue.append((time.monotonic(), message))
+        waiter = self.local_waiters.pop(channel, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        self.sweep()
+
+    def sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for channel in list(self.local_queues):
+            queue = self.local_queues[channel]
+            while queue and now - queue[0][0] > self.expiry:
+                queue.popleft()
+            if not queue and channel not in self.local_waiters:
+                del self.local_queues[channel]
+
+    async def send(self, channel, message):
+        if not self.is_local(channel):
+            metrics.channel_layer_deliveries.inc(path="redis")
+            return await super().send(channel, message)
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if len(self.local_queues[channel]) >= self.get_capacity(channel):
+            raise ChannelFull()
+        metrics.channel_layer_deliveries.inc(path="local")
+        self.deliver_locally(channel, self.unpack(self.pack(message)))
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # RedisChannelLayer.group_send reads the group members from Redis and
+        # hands them to this method to bucket by shard, so local members are
+        # peeled off here and only remote ones are left for the Lua script.
+        # Every local member gets its own copy of the message.
+        count_recipients(len(channel_names))
+        remote_channels = []
+        dropped = 0
+        packed = None
+        for channel in channel_names:
+            if self.is_local(channel):
+                queue = self.local_queues[channel]
+                if len(queue) < self.get_capacity(channel):
+                    metrics.channel_layer_deliveries.inc(path="local")
+                    if packed is None:
+                        packed = self.pack(message)
+                    self.deliver_locally(channel, self.unpack(packed))
+                else:
+                    dropped += 1
+            else:
+                metrics.channel_layer_deliveries.inc(path="redis")
+                remote_channels.append(channel)
+        if dropped:
+            metrics.channel_layer_drops.inc(dropped, reason="full")
+            logger.info(f"{dropped} local channels over capacity")
+        return super()._map_channel_keys_to_connection(remote_channels, message)
+
+    # The same script RedisChannelLayer.group_send runs per shard, with the
+    # expired messages trimmed inline instead of in a separate pipeline.
+    send_many_lua = """
+        local over_capacity = 0
+        local current_time = ARGV[#ARGV - 1]
+        local expiry = ARGV[#ARGV]
+        for i=1,#KEYS do
+            redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, current_time - expiry)
+            if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+                redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            else
+                over_capacity = over_capacity + 1
+            end
+        end
+        return over_capacity
+    """
+
+    async def group_send_many(self, groups, message):
+        # Members are read for every group up front and deduplicated, so a
+        # channel subscribed to several of the groups gets the message once.
+        group_keys = collections.defaultdict(list)
+        for group in groups:
+            assert self.valid_group_name(group), "Group name not valid"
+            group_keys[self.consistent_hash(group)].append(self._group_key(group))
+        channel_names = set()
+        for index, keys in group_keys.items():
+            async with self.connection(index) as connection:
+                pipe = connection.pipeline()
+                for key in keys:
+                    pipe.zremrangebyscore(
+                        key, min=0, max=int(time.time()) - self.group_expiry
+                    )
+                    pipe.zrange(key, 0, -1)
+                results = await pipe.execute()
+            channel_names.update(
+                channel.decode("utf8")
+                for members in results[1::2]
+                for channel in members
+            )
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(sorted(channel_names), message)
+        for index, channel_keys in connection_to_channel_keys.items():
+            args = [channel_keys_to_message[key] for key in channel_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_keys]
+            args += [time.time(), self.expiry]
+            async with self.connection(index) as connection:
+                over_capacity = await connection.eval(
+                    self.send_many_lua, keys=channel_keys, args=args
+                )
+            if over_capacity > 0:
+                logger.info(
+                    f"{over_capacity} of {len(channel_names)} channels over "
+                    f"capacity in {len(groups)} groups"
+                )
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+        assert self.valid_channel_name(channel)
+        self.ensure_pump(self.non_local_name(channel))
+        queue = self.local_queues[channel]
+        while True:
+            while queue:
+                sent_at, message = queue.popleft()
+                if time.monotonic() - sent_at <= self.expiry:
+                    if not queue:
+                        self.local_queues.pop(channel, None)
+                    return message
+            waiter = asyncio.get_running_loop().create_future()
+            self.local_waiters[channel] = waiter
+            try:
+                await waiter
+            finally:
+                if self.local_waiters.get(channel) is waiter:
+                    del self.local_waiters[channel]
+            queue = self.local_queues[channel]
+
+    def ensure_pump(self, real_channel):
+        loop = asyncio.get_running_loop()
+        pump = self.pump_tasks.get(real_channel)
+        if pump is None or pump.done() or pump.get_loop() is not loop:
+            self.pump_tasks[real_channel] = loop.create_task(self.pump(real_channel))
+
+    async def pump(self, real_channel):
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Failed to receive from {real_channel}")
+                await asyncio.sleep(1)
+                continue
+            if isinstance(message_channel, list):
+                for channel in message_channel:
+                    self.deliver_locally(channel, copy.deepcopy(message))
+            else:
+                self.deliver_locally(message_channel, message)
+
+    def serialize(self, message):
+        value = self.pack(message)
+        if self.crypter:
+            value = self.crypter.encrypt(value)
+        random_prefix = random.getrandbits(8 * 12).to_bytes(12, "big")
+        return random_prefix + value
+
+    async def flush(self):
+        self.local_queues.clear()
+        await super().flush()
+
+    async def close_pools(self):
+        for pump in self.pump_tasks.values():
+            pump.cancel()
+        self.pump_tasks.clear()
+        await super().close_pools()
+
+
+async def group_send_many(channel_layer, groups, message):
+    if hasattr(channel_layer, "group_send_many"):
+        await channel_layer.group_send_many(groups, message)
+    elif hasattr(channel_layer, "groups"):
+        # InMemoryChannelLayer keeps its groups in a dict, so the members are
+        # collected and deduplicated here the same way the hybrid layer does.
+        channel_layer._clean_expired()
+        channel_names = set()
+        for group in groups:
+            assert channel_layer.valid_group_name(group), "Group name not valid"
+            channel_names.update(channel_layer.groups.get(group, ()))
+        count_recipients(len(channel_names))
+        for channel in sorted(channel_names):
+            try:
+                await channel_layer.send(channel, message)
+            except ChannelFull:
+                pass
+    else:
+        await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group in groups)
+        )
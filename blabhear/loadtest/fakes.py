@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import hmac
+import sys
+import time
+import types
+from urllib.parse import parse_qs, urlparse
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+
+from blabhear.models import User
+
+
+class FakeSigner:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def sign(self, blob_name, method):
+        if self.latency:
+            # Real V4 signing is synchronous CPU work, so block like it does.
+            time.sleep(self.latency)
+        signature = hmac.new(
+            b"loadtest", f"{method}:{blob_name}".encode(), hashlib.sha256
+        ).hexdigest()
+        return f"https://storage.invalid/{blob_name}?X-Goog-Signature={signature}"
+
+    def generate_upload_signed_url_v4(self, blob_name):
+        return self.sign(blob_name, "PUT")
+
+    def generate_download_signed_url_v4(self, blob_name):
+        return self.sign(blob_name, "GET")
+
+
+class FakeDeepgram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.transcription = self
+
+    async def prerecorded(self, source, options):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        blob_name = urlparse(source["url"]).path.rsplit("/", 1)[-1]
+        return {
+            "results": {
+                "channels": [
+                    {"alternatives": [{"transcript": transcript_for(blob_name)}]}
+                ]
+            }
+        }
+
+
+def transcript_for(blob_name):
+    return f"transcript of {blob_name}"
+
+
+@database_sync_to_async
+def get_user(token):
+    user, created = User.objects.get_or_create(username=token)
+    return user
+
+
+class FakeTokenAuthMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        scope["user"] = await get_user(
+            parse_qs(scope["query_string"].decode())["token"][0]
+        )
+        return await self.app(scope, receive, send)
+
+
+def FakeTokenAuthMiddlewareStack(app):
+    return FakeTokenAuthMiddleware(AuthMiddlewareStack(app))
+
+
+def install(signer, deepgram):
+    storage = types.ModuleType("blabhear.storage")
+    storage.generate_upload_signed_url_v4 = signer.generate_upload_signed_url_v4
+    storage.generate_download_signed_url_v4 = signer.generate_download_signed_url_v4
+    sys.modules["blabhear.storage"] = storage
+
+    from blabhear import consumers
+
+    consumers.generate_upload_signed_url_v4 = signer.generate_upload_signed_url_v4
+    consumers.generate_download_signed_url_v4 = signer.generate_download_signed_url_v4
+    consumers.DEEPGRAM_CLIENT = deepgram
@@ -0,0 +1,372 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from blabhear.loadtest.fakes import FakeTokenAuthMiddlewareStack, transcript_for
+from blabhear.models import Message, Notification, Room, User
+
+USERNAME_PREFIX = "loadtest-"
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.frames = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def record(self, command, latency):
+        self.latencies.setdefault(command, []).append(latency)
+
+    def record_error(self, command):
+        self.errors[command] = self.errors.get(command, 0) + 1
+
+    def report(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        commands = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies.get(command, [])
+            commands[command] = {
+                "count": len(latencies),
+                "errors": self.errors.get(command, 0),
+                "throughput": len(latencies) / elapsed if elapsed else 0,
+                "p50_ms": self.to_ms(percentile(latencies, 0.50)),
+                "p95_ms": self.to_ms(percentile(latencies, 0.95)),
+                "p99_ms": self.to_ms(percentile(latencies, 0.99)),
+                "max_ms": self.to_ms(max(latencies) if latencies else None),
+            }
+        completed = sum(command["count"] for command in commands.values())
+        return {
+            "elapsed_s": elapsed,
+            "commands": commands,
+            "total_throughput": completed / elapsed if elapsed else 0,
+            "frames_received": self.frames,
+        }
+
+    @staticmethod
+    def to_ms(seconds):
+        if seconds is None:
+            return None
+        return round(seconds * 1000, 3)
+
+
+class Connection:
+    def __init__(self, application, path, stats):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.stats = stats
+        self.waiters = []
+        self.reader = None
+
+    async def open(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if connected:
+            self.reader = asyncio.create_task(self.read())
+        return connected
+
+    async def read(self):
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output["type"] == "websocket.close":
+                break
+            if not output.get("text"):
+                continue
+            frame = json.loads(output["text"])
+            self.stats.frames += 1
+            for waiter in list(self.waiters):
+                predicate, future = waiter
+                if not future.done() and predicate(frame):
+                    future.set_result(frame)
+                    self.waiters.remove(waiter)
+
+    def expect(self, predicate):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((predicate, future))
+        return future
+
+    async def request(self, command, payload, predicate, timeout):
+        future = self.expect(predicate)
+        started_at = time.monotonic()
+        if payload is not None:
+            await self.communicator.send_json_to(payload)
+        try:
+            frame = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats.record_error(command)
+            return None
+        self.stats.record(command, time.monotonic() - started_at)
+        return frame
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+def frame_type(expected_type, **expected_values):
+    def predicate(frame):
+        if frame.get("type") != expected_type:
+            return False
+        return all(frame.get(key) == value for key, value in expected_values.items())
+
+    return predicate
+
+
+def new_message_with_content(content):
+    def predicate(frame):
+        return (
+            frame.get("type") == "new_message"
+            and frame["new_message"]["content"] == content
+        )
+
+    return predicate
+
+
+class Workload:
+    def __init__(
+        self,
+        *,
+        users,
+        rooms,
+        actions_per_user,
+        mix,
+        private_ratio,
+        voice_ratio,
+        seed_messages,
+        max_scroll_page,
+        think_time,
+        ramp_up,
+        timeout,
+        inbox,
+        seed,
+    ):
+        self.users = users
+        self.rooms = rooms
+        self.actions_per_user = actions_per_user
+        self.mix = mix
+        self.private_ratio = private_ratio
+        self.voice_ratio = voice_ratio
+        self.seed_messages = seed_messages
+        self.max_scroll_page = max_scroll_page
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.timeout = timeout
+        self.inbox = inbox
+        self.random = random.Random(seed)
+
+    def next_action(self):
+        actions = list(self.mix)
+        weights = [self.mix[action] for action in actions]
+        return self.random.choices(actions, weights=weights)[0]
+
+
+class VirtualUser:
+    def __init__(self, application, workload, stats, username, room_id, owner):
+        self.application = application
+        self.workload = workload
+        self.stats = stats
+        self.username = username
+        self.room_id = room_id
+        self.owner = owner
+        self.inbox = None
+        self.room = None
+
+    async def run(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            if self.workload.inbox:
+                self.inbox = Connection(
+                    self.application,
+                    f"/ws/user/{self.username}/?token={self.username}",
+                    self.stats,
+                )
+                notifications = self.inbox.expect(frame_type("notifications"))
+                started_at = time.monotonic()
+                if not await self.inbox.open(self.workload.timeout):
+                    self.stats.record_error("user_connect")
+                    return
+                await asyncio.wait_for(notifications, self.workload.timeout)
+                self.stats.record("user_connect", time.monotonic() - started_at)
+            self.room = Connection(
+                self.application, f"/ws/room/?token={self.username}", self.stats
+            )
+            if not await self.room.open(self.workload.timeout):
+                self.stats.record_error("join")
+                return
+            allowed = await self.join()
+            if allowed:
+                for _ in range(self.workload.actions_per_user):
+                    await self.think()
+                    await getattr(self, self.workload.next_action())()
+        except asyncio.TimeoutError:
+            self.stats.record_error("user_connect")
+        finally:
+            for connection in (self.room, self.inbox):
+                if connection:
+                    await connection.close()
+
+    async def think(self):
+        if self.workload.think_time:
+            await asyncio.sleep(
+                self.workload.random.expovariate(1 / self.workload.think_time)
+            )
+
+    async def join(self):
+        joined = self.room.expect(
+            lambda frame: frame.get("type") in ("allowed", "room_bootstrap")
+        )
+        started_at = time.monotonic()
+        await self.room.communicator.send_json_to(
+            {"command": "connect", "room": self.room_id}
+        )
+        try:
+            frame = await asyncio.wait_for(joined, self.workload.timeout)
+            if not frame["allowed"]:
+                self.stats.record("join_pending", time.monotonic() - started_at)
+                return await self.wait_for_approval()
+        except asyncio.TimeoutError:
+            self.stats.record_error("join")
+            return False
+        self.stats.record("join", time.monotonic() - started_at)
+        return True
+
+    async def wait_for_approval(self):
+        for _ in range(self.workload.actions_per_user):
+            await self.think()
+            frame = await self.room.request(
+                "fetch_allowed_status",
+                {"command": "fetch_allowed_status"},
+                frame_type("allowed"),
+                self.workload.timeout,
+            )
+            if frame and frame["allowed"]:
+                return True
+        return False
+
+    async def post(self):
+        if self.workload.random.random() < self.workload.voice_ratio:
+            frame = await self.room.request(
+                "fetch_upload_url",
+                {"command": "fetch_upload_url"},
+                frame_type("upload_url"),
+                self.workload.timeout,
+            )
+            if not frame:
+                return
+            await self.room.request(
+                "send_message_voice",
+                {
+                    "command": "send_message",
+                    "dry_filename": frame["dry_filename"],
+                    "wet_filename": frame["wet_filename"],
+                    "message_key": str(uuid.uuid4()),
+                },
+                new_message_with_content(transcript_for(frame["dry_filename"])),
+                self.workload.timeout,
+            )
+        else:
+            content = f"{self.username} says {uuid.uuid4()}"
+            await self.room.request(
+                "send_message",
+                {
+                    "command": "send_message",
+                    "message": content,
+                    "message_key": str(uuid.uuid4()),
+                },
+                new_message_with_content(content),
+                self.workload.timeout,
+            )
+
+    async def scroll(self):
+        page = self.workload.random.randint(1, self.workload.max_scroll_page)
+        await self.room.request(
+            "fetch_messages",
+            {"command": "fetch_messages", "page": page},
+            frame_type("messages", page=page),
+            self.workload.timeout,
+        )
+
+    async def approve(self):
+        if not self.owner:
+            return await self.scroll()
+        await self.room.request(
+            "approve_all_users",
+            {"command": "approve_all_users"},
+            frame_type("refresh_join_requests"),
+            self.workload.timeout,
+        )
+
+
+def seed_rooms(workload):
+    users = [
+        User(username=f"{USERNAME_PREFIX}{uuid.uuid4().hex}")
+        for _ in range(workload.users)
+    ]
+    for user in users:
+        user.save()
+    rooms = []
+    for index in range(workload.rooms):
+        room = Room.objects.create(
+            private=workload.random.random() < workload.private_ratio,
+            display_name=f"{USERNAME_PREFIX}room-{index}",
+        )
+        rooms.append(room)
+    assignments = []
+    for index, user in enumerate(users):
+        room = rooms[index % len(rooms)]
+        owner = index < len(rooms)
+        if owner:
+            room.members.add(user)
+            Message.objects.bulk_create(
+                Message(creator=user, room=room, content=f"seed message {number}")
+                for number in range(workload.seed_messages)
+            )
+            Notification.objects.create(
+                user=user,
+                room=room,
+                message=room.message_set.order_by("-created_at").first(),
+            )
+        assignments.append((user.username, str(room.id), owner))
+    return assignments
+
+
+def clean_up(assignments):
+    room_ids = {room_id for username, room_id, owner in assignments}
+    Room.objects.filter(id__in=room_ids).delete()
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+
+async def run(workload, url_patterns):
+    application = FakeTokenAuthMiddlewareStack(URLRouter(url_patterns))
+    stats = Stats()
+    assignments = await database_sync_to_async(seed_rooms)(workload)
+    virtual_users = [
+        VirtualUser(application, workload, stats, username, room_id, owner)
+        for username, room_id, owner in assignments
+    ]
+    stats.started_at = time.monotonic()
+    try:
+        await asyncio.gather(
+            *[
+                virtual_user.run(workload.ramp_up * index / max(1, len(virtual_users)))
+                for index, virtual_user in enumerate(virtual_users)
+            ]
+        )
+    finally:
+        stats.finished_at = time.monotonic()
+        await database_sync_to_async(clean_up)(assignments)
+    return stats.report()
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from django.conf import settings
+
+from blabhear import metrics
+
+logger = logging.getLogger(__name__)
+
+active_commands = weakref.WeakKeyDictionary()
+monitored_loops = weakref.WeakSet()
+
+
+def track_command(consumer, command):
+    task = asyncio.current_task()
+    if task is not None:
+        active_commands[task] = (consumer, command)
+    return task
+
+
+def untrack_command(task):
+    if task is not None:
+        active_commands.pop(task, None)
+
+
+def describe_task(loop):
+    task = asyncio.current_task(loop)
+    if task is None:
+        return None, None
+    consumer, command = active_commands.get(task, (None, None))
+    return task.get_name(), f"{consumer}.{command}" if command else None
+
+
+class LoopMonitor:
+    def __init__(self, loop, interval, threshold, stack_depth):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.reported_heartbeat = None
+        self.lag_task = None
+        self.watchdog = threading.Thread(
+            target=self.watch, name="loop-monitor", daemon=True
+        )
+
+    def start(self):
+        self.lag_task = self.loop.create_task(self.measure_lag())
+        self.watchdog.start()
+
+    async def measure_lag(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            lag = max(0.0, self.heartbeat - started_at - self.interval)
+            metrics.event_loop_lag.observe(lag)
+
+    def watch(self):
+        while not self.loop.is_closed():
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.threshold or heartbeat == self.reported_heartbeat:
+                continue
+            self.reported_heartbeat = heartbeat
+            self.report(stalled_for)
+
+    def report(self, stalled_for):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=-self.stack_depth))
+        task_name, command = describe_task(self.loop)
+        metrics.event_loop_stalls.inc(command=command or "none")
+        logger.warning(
+            f"Event loop blocked for at least {stalled_for * 1000:.0f}ms "
+            f"in task {task_name} running command {command}\n{stack}"
+        )
+
+
+def start():
+    if not settings.LOOP_MONITOR:
+        return
+    loop = asyncio.get_running_loop()
+    if loop in monitored_loops:
+        return
+    monitored_loops.add(loop)
+    LoopMonitor(
+        loop,
+        interval=settings.LOOP_MONITOR_INTERVAL_MS / 1000,
+        threshold=settings.LOOP_MONITOR_THRESHOLD_MS / 1000,
+        stack_depth=settings.LOOP_MONITOR_STACK_DEPTH,
+    ).start()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from blabhear import asyncdb
+from blabhear.instrumentation import database_sync_to_async
+from blabhear.management.commands.benchmark_queries import (
+    SCENARIOS,
+    USERNAME_PREFIX,
+    seed,
+)
+from blabhear.models import Room, User
+
+QUERIES = (
+    "user_not_allowed",
+    "get_recording_settings",
+    "create_new_message",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a room and compare the throughput and latency of the hottest room "
+        "queries through the thread pool ORM path and the native asyncpg path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenario", choices=list(SCENARIOS), default="medium")
+        parser.add_argument("--iterations", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--json", help="Write results as JSON to this path")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("The native async path needs PostgreSQL")
+
+        # The asyncpg pool has its own connections, so the seed data has to be
+        # committed rather than rolled back like benchmark_queries does.
+        room, owner = seed(SCENARIOS[options["scenario"]])
+        try:
+            results = asyncio.run(
+                self.run_queries(
+                    str(room.id), owner, options["iterations"], options["concurrency"]
+                )
+            )
+        finally:
+            Room.objects.filter(display_name__startswith=USERNAME_PREFIX).delete()
+            User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+        self.stdout.write(
+            f"{'query':<32}{'path':<8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+        )
+        for result in results:
+            self.stdout.write(
+                f"{result['query']:<32}{result['path']:<8}"
+                f"{result['ops_per_second']:>10.1f}"
+                f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+            )
+        if options["json"]:
+            with open(options["json"], "w") as output:
+                json.dump(
+                    {
+                        "scenario": options["scenario"],
+                        "iterations": options["iterations"],
+                        "concurrency": options["concurrency"],
+                        "results": results,
+                    },
+                    output,
+                    indent=2,
+                )
+
+    async def run_queries(self, room_id, user, iterations, concurrency):
+        from blabhear.consumers import RoomConsumer
+
+        def uncached(helper, *args):
+            # A fresh consumer per call, so the sync path pays for its queries
+            # instead of reading the per-connection room state.
+            def call():
+                room_consumer = RoomConsumer()
+                room_consumer.room_id = room_id
+                room_consumer.user = user
+                return getattr(room_consumer, helper)(*args)
+
+            call.__name__ = helper
+            return database_sync_to_async(call)
+
+        paths = {
+            "user_not_allowed": (
+                uncached("user_not_allowed"),
+                lambda: asyncdb.user_not_allowed(room_id, user),
+            ),
+            "get_recording_settings": (
+                uncached("get_recording_settings"),
+                lambda: asyncdb.get_recording_settings(room_id, user),
+            ),
+            "create_new_message": (
+                uncached("create_new_message", "benchmark message", None),
+                lambda: asyncdb.create_new_message(
+                    room_id, user, "benchmark message", None
+                ),
+            ),
+        }
+        results = []
+        try:
+            for query in QUERIES:
+                sync_path, native_path = paths[query]
+                for path, func in (("sync", sync_path), ("native", native_path)):
+                    results.append(
+                        await self.measure(query, path, func, iterations, concurrency)
+                    )
+        finally:
+            await asyncdb.close_pool()
+        return results
+
+    async def measure(self, query, path, func, iterations, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        timings = []
+
+        async def timed():
+            async with semaphore:
+                started_at = time.perf_counter()
+                await func()
+                timings.append(time.perf_counter() - started_at)
+
+        # One untimed call warms up the pool, prepared statements and threads.
+        await func()
+        started_at = time.perf_counter()
+        await asyncio.gather(*(timed() for _ in range(max(1, iterations))))
+        elapsed = time.perf_counter() - started_at
+        return {
+            "query": query,
+            "path": path,
+            "ops_per_second": len(timings) / elapsed,
+            "p50_ms": statistics.median(timings) * 1000,
+            "p95_ms": statistics.quantiles(timings, n=20)[-1] * 1000
+            if len(timings) > 1
+            else timings[0] * 1000,
+        }
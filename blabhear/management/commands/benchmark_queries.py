@@ -0,0 +1,307 @@
+import json
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.utils import NotSupportedError
+
+from blabhear.loadtest import fakes
+from blabhear.models import (
+    JoinRequest,
+    Message,
+    Notification,
+    RecordingSettings,
+    Room,
+    User,
+)
+
+USERNAME_PREFIX = "benchmark-"
+SCENARIOS = {
+    "small": {"members": 5, "messages": 50, "join_requests": 2, "rooms_per_user": 5},
+    "medium": {
+        "members": 50,
+        "messages": 1000,
+        "join_requests": 10,
+        "rooms_per_user": 20,
+    },
+    "large": {
+        "members": 500,
+        "messages": 10000,
+        "join_requests": 50,
+        "rooms_per_user": 100,
+    },
+}
+HISTORY_PAGES = 5
+# Query budgets are constant: no helper should issue more queries because a
+# room has more members, messages or join requests, so a per-row query shows
+# up as a failure at the larger scenarios. Latency budgets grow with data size,
+# are deliberately loose and can be scaled for slower machines with
+# --latency-scale.
+BUDGETS = {
+    "fetch_messages": {
+        "queries": lambda scenario: 3,
+        "latency_ms": lambda scenario: 50 + 0.01 * scenario["messages"],
+    },
+    "fetch_messages_up_to_page": {
+        "queries": lambda scenario: 1 + 2 * HISTORY_PAGES,
+        "latency_ms": lambda scenario: 50 + 0.01 * HISTORY_PAGES * scenario["messages"],
+    },
+    "get_playable_filenames": {
+        "queries": lambda scenario: 1,
+        "latency_ms": lambda scenario: 50,
+    },
+    "get_user_notifications": {
+        "queries": lambda scenario: 1,
+        "latency_ms": lambda scenario: 50 + 0.5 * scenario["rooms_per_user"],
+    },
+    "approve_all_room_members": {
+        "queries": lambda scenario: 7,
+        "latency_ms": lambda scenario: 50 + scenario["join_requests"],
+    },
+    "create_new_message": {
+        "queries": lambda scenario: 5,
+        "latency_ms": lambda scenario: 100,
+    },
+    "leave_room": {
+        "queries": lambda scenario: 5,
+        "latency_ms": lambda scenario: 50,
+    },
+    "search_room_messages": {
+        "queries": lambda scenario: 1,
+        "latency_ms": lambda scenario: 50 + 0.01 * scenario["messages"],
+    },
+    "bootstrap_room": {
+        "queries": lambda scenario: 5,
+        "latency_ms": lambda scenario: 50,
+    },
+    "get_roster_page": {
+        "queries": lambda scenario: 1,
+        "latency_ms": lambda scenario: 50,
+    },
+    "sync_messages_since": {
+        "queries": lambda scenario: 3,
+        "latency_ms": lambda scenario: 50,
+    },
+    "room.change_display_name": {
+        "queries": lambda scenario: 2,
+        "latency_ms": lambda scenario: 50,
+    },
+    "user.change_display_name": {
+        "queries": lambda scenario: 2,
+        "latency_ms": lambda scenario: 50 + 0.5 * scenario["rooms_per_user"],
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed rooms at several sizes, time the consumers' sync helpers and check "
+        "their query counts against constant budgets and their latencies against "
+        "budgets that scale with data size. Exits with an error when a budget is "
+        "exceeded."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=list(SCENARIOS),
+            help="Scenario to run, can be repeated. Defaults to all of them.",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--latency-scale", type=float, default=1.0)
+        parser.add_argument("--json", help="Write results as JSON to this path")
+
+    def handle(self, *args, **options):
+        fakes.install(fakes.FakeSigner(), fakes.FakeDeepgram())
+
+        results = []
+        for name in options["scenario"] or list(SCENARIOS):
+            results += self.run_scenario(
+                name, SCENARIOS[name], options["repeat"], options["latency_scale"]
+            )
+
+        self.stdout.write(
+            f"{'scenario':<10}{'helper':<28}{'queries':>10}{'budget':>8}"
+            f"{'median ms':>12}{'budget ms':>12}"
+        )
+        for result in results:
+            if result["skipped"]:
+                self.stdout.write(
+                    f"{result['scenario']:<10}{result['helper']:<28}"
+                    f"  skipped: {result['skipped']}"
+                )
+                continue
+            line = (
+                f"{result['scenario']:<10}{result['helper']:<28}"
+                f"{result['queries']:>10}{result['query_budget']:>8}"
+                f"{result['median_ms']:>12.2f}{result['latency_budget_ms']:>12.2f}"
+            )
+            if result["passed"]:
+                self.stdout.write(line)
+            else:
+                self.stdout.write(self.style.ERROR(line))
+        if options["json"]:
+            with open(options["json"], "w") as output:
+                json.dump(
+                    {"vendor": connection.vendor, "results": results}, output, indent=2
+                )
+        failures = [
+            f"{result['scenario']}/{result['helper']}"
+            for result in results
+            if not result["skipped"] and not result["passed"]
+        ]
+        if failures:
+            raise CommandError(f"Budgets exceeded: {', '.join(failures)}")
+
+    def run_scenario(self, name, scenario, repeat, latency_scale):
+        from blabhear.consumers import RoomConsumer, UserConsumer
+
+        with transaction.atomic():
+            room, owner = seed(scenario)
+
+            # A fresh consumer per call, so no helper reads the room state an
+            # earlier one cached and each pays for its own queries.
+            def room_consumer():
+                consumer = RoomConsumer()
+                consumer.room_id = str(room.id)
+                consumer.user = owner
+                return consumer
+
+            def user_consumer():
+                consumer = UserConsumer()
+                consumer.user = owner
+                consumer.username = owner.username
+                return consumer
+
+            newest_id = room.message_set.order_by("-created_at").values_list(
+                "id", flat=True
+            )[10]
+            helpers = {
+                "fetch_messages": lambda: room_consumer().fetch_messages(page=2),
+                "fetch_messages_up_to_page": lambda: (
+                    room_consumer().fetch_messages_up_to_page(page=HISTORY_PAGES)
+                ),
+                "get_playable_filenames": lambda: (
+                    room_consumer().get_playable_filenames(
+                        [str(uuid.uuid4()) for _ in range(50)]
+                    )
+                ),
+                "get_user_notifications": lambda: (
+                    user_consumer().get_user_notifications()
+                ),
+                "approve_all_room_members": lambda: (
+                    room_consumer().approve_all_room_members()
+                ),
+                "create_new_message": lambda: room_consumer().create_new_message(
+                    "benchmark message", None
+                ),
+                "leave_room": lambda: user_consumer().leave_room(room.id),
+                "bootstrap_room": lambda: room_consumer().bootstrap_room(),
+                "get_roster_page": lambda: room_consumer().get_roster_page(),
+                "sync_messages_since": lambda: room_consumer().sync_messages_since(
+                    newest_id, None
+                ),
+                "search_room_messages": lambda: (
+                    user_consumer().search_room_messages("message", None)
+                ),
+                "room.change_display_name": lambda: (
+                    room_consumer().change_display_name("benchmark room")
+                ),
+                "user.change_display_name": lambda: (
+                    user_consumer().change_display_name("benchmark user")
+                ),
+            }
+            results = [
+                self.measure(name, scenario, helper, func, repeat, latency_scale)
+                for helper, func in helpers.items()
+            ]
+            transaction.set_rollback(True)
+        return results
+
+    def measure(self, name, scenario, helper, func, repeat, latency_scale):
+        result = {
+            "scenario": name,
+            "helper": helper,
+            "size": scenario,
+            "skipped": None,
+        }
+        timings = []
+        queries = 0
+        for _ in range(max(1, repeat)):
+            counter = QueryCounter()
+            try:
+                with transaction.atomic():
+                    with connection.execute_wrapper(counter):
+                        started_at = time.perf_counter()
+                        func()
+                        timings.append(time.perf_counter() - started_at)
+                    transaction.set_rollback(True)
+            except NotSupportedError as error:
+                result["skipped"] = str(error)
+                return result
+            queries = max(queries, counter.count)
+        budget = BUDGETS[helper]
+        result.update(
+            {
+                "queries": queries,
+                "query_budget": budget["queries"](scenario),
+                "median_ms": statistics.median(timings) * 1000,
+                "max_ms": max(timings) * 1000,
+                "latency_budget_ms": budget["latency_ms"](scenario) * latency_scale,
+            }
+        )
+        result["passed"] = (
+            result["queries"] <= result["query_budget"]
+            and result["median_ms"] <= result["latency_budget_ms"]
+        )
+        return result
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def seed(scenario):
+    def new_user():
+        user = User(username=f"{USERNAME_PREFIX}{uuid.uuid4().hex}")
+        user.save()
+        return user
+
+    members = [new_user() for _ in range(scenario["members"])]
+    owner = members[0]
+    room = Room.objects.create(display_name=f"{USERNAME_PREFIX}room")
+    room.members.add(*members)
+    Message.objects.bulk_create(
+        Message(
+            creator=members[number % len(members)],
+            room=room,
+            content=f"benchmark message {number}",
+        )
+        for number in range(scenario["messages"])
+    )
+    latest_message = room.message_set.order_by("-created_at").first()
+    Notification.objects.bulk_create(
+        Notification(user=member, room=room, message=latest_message)
+        for member in members
+    )
+    RecordingSettings.objects.create(user=owner, room=room)
+    requesters = [new_user() for _ in range(scenario["join_requests"])]
+    JoinRequest.objects.bulk_create(
+        JoinRequest(user=requester, room=room) for requester in requesters
+    )
+    for number in range(scenario["rooms_per_user"] - 1):
+        other_room = Room.objects.create(display_name=f"{USERNAME_PREFIX}room-{number}")
+        other_room.members.add(owner)
+        message = Message.objects.create(
+            creator=owner, room=other_room, content=f"benchmark message {number}"
+        )
+        Notification.objects.create(user=owner, room=other_room, message=message)
+    return room, owner
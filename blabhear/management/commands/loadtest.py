@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from blabhear.loadtest import fakes
+
+ACTIONS = ("post", "scroll", "approve")
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        action, _, weight = item.partition("=")
+        action = action.strip()
+        if action not in ACTIONS:
+            raise CommandError(f"Unknown action {action}, expected one of {ACTIONS}")
+        try:
+            mix[action] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight for action {action}: {weight}")
+    if not any(mix.values()):
+        raise CommandError("At least one action needs a positive weight")
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive RoomConsumer and UserConsumer with simulated users and report "
+        "per-command latency percentiles and throughput. Firebase auth, GCS "
+        "signing and Deepgram are replaced by in-process fakes. The user inbox "
+        "query needs the Postgres database configured in DATABASE_URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--actions-per-user", type=int, default=20)
+        parser.add_argument(
+            "--mix",
+            type=parse_mix,
+            default="post=5,scroll=4,approve=1",
+            help="Weighted actions, e.g. post=5,scroll=4,approve=1",
+        )
+        parser.add_argument(
+            "--private-ratio",
+            type=float,
+            default=0.2,
+            help="Fraction of rooms that are private and need approval to join",
+        )
+        parser.add_argument(
+            "--voice-ratio",
+            type=float,
+            default=0.5,
+            help="Fraction of posts sent as recordings that go through Deepgram",
+        )
+        parser.add_argument("--seed-messages", type=int, default=100)
+        parser.add_argument("--max-scroll-page", type=int, default=5)
+        parser.add_argument(
+            "--think-time", type=float, default=0.1, help="Mean seconds"
+        )
+        parser.add_argument("--ramp-up", type=float, default=1.0, help="Seconds")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds")
+        parser.add_argument("--signing-ms", type=float, default=2.0)
+        parser.add_argument("--transcription-ms", type=float, default=500.0)
+        parser.add_argument(
+            "--channel-layer",
+            choices=["memory", "redis"],
+            default="memory",
+            help="Use an in-memory channel layer or the configured Redis layer",
+        )
+        parser.add_argument(
+            "--no-inbox",
+            action="store_true",
+            help="Only open room sockets, without the ws/user/ inbox socket",
+        )
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument("--json", help="Write the report as JSON to this path")
+
+    def handle(self, *args, **options):
+        fakes.install(
+            fakes.FakeSigner(latency=options["signing_ms"] / 1000),
+            fakes.FakeDeepgram(latency=options["transcription_ms"] / 1000),
+        )
+        from blabhear import routing
+        from blabhear.loadtest import runner
+
+        workload = runner.Workload(
+            users=options["users"],
+            rooms=max(1, options["rooms"]),
+            actions_per_user=options["actions_per_user"],
+            mix=options["mix"],
+            private_ratio=options["private_ratio"],
+            voice_ratio=options["voice_ratio"],
+            seed_messages=options["seed_messages"],
+            max_scroll_page=options["max_scroll_page"],
+            think_time=options["think_time"],
+            ramp_up=options["ramp_up"],
+            timeout=options["timeout"],
+            inbox=not options["no_inbox"],
+            seed=options["seed"],
+        )
+        if options["channel_layer"] == "memory":
+            with override_settings(
+                CHANNEL_LAYERS={
+                    "default": {
+                        "BACKEND": "channels.layers.InMemoryChannelLayer",
+                        "CONFIG": {"capacity": 1000},
+                    }
+                }
+            ):
+                report = asyncio.run(
+                    runner.run(workload, routing.websocket_urlpatterns)
+                )
+        else:
+            report = asyncio.run(runner.run(workload, routing.websocket_urlpatterns))
+
+        self.stdout.write(
+            f"{'command':<24}{'count':>8}{'errors':>8}{'req/s':>10}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        )
+        for command, result in report["commands"].items():
+            self.stdout.write(
+                f"{command:<24}{result['count']:>8}{result['errors']:>8}"
+                f"{result['throughput']:>10.1f}"
+                + "".join(
+                    f"{result[key] if result[key] is not None else '-':>10}"
+                    for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")
+                )
+            )
+        self.stdout.write(
+            f"{report['elapsed_s']:.1f}s elapsed, "
+            f"{report['total_throughput']:.1f} commands/s, "
+            f"{report['frames_received']} frames received"
+        )
+        if options["json"]:
+            with open(options["json"], "w") as output:
+                json.dump(report, output, indent=2)
@@ -0,0 +1,257 @@
+import abc
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+REGISTRY = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    formatted = ",".join(
+        f'{name}="{escape(str(value))}"' for name, value in sorted(labels.items())
+    )
+    return "{" + formatted + "}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self):
+        pass
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self.lock:
+            for name, labels, value in self.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, "le": bound}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+command_duration = Histogram(
+    "blabhear_command_duration_seconds",
+    "Time to handle an inbound WebSocket command.",
+    ["consumer", "command"],
+)
+commands_in_flight = Gauge(
+    "blabhear_commands_in_flight",
+    "Command tasks currently running.",
+    ["consumer"],
+)
+open_connections = Gauge(
+    "blabhear_open_connections",
+    "Open WebSocket connections.",
+    ["consumer"],
+)
+db_queries = Counter(
+    "blabhear_db_queries_total",
+    "Database queries issued while handling a command.",
+    ["command"],
+)
+db_query_seconds = Counter(
+    "blabhear_db_query_seconds_total",
+    "Time spent in database queries while handling a command.",
+    ["command"],
+)
+group_send_duration = Histogram(
+    "blabhear_group_send_duration_seconds",
+    "Time for one channel layer group_send.",
+    ["type"],
+)
+group_send_recipients_per_command = Histogram(
+    "blabhear_group_send_recipients_per_command",
+    "Number of channels the group sends of one command were addressed to.",
+    ["command"],
+    buckets=COUNT_BUCKETS,
+)
+signing_duration = Histogram(
+    "blabhear_signing_duration_seconds",
+    "Time to sign a storage URL.",
+    ["method"],
+)
+transcription_duration = Histogram(
+    "blabhear_transcription_duration_seconds",
+    "Time for a Deepgram transcription request.",
+    ["outcome"],
+)
+cache_requests = Counter(
+    "blabhear_cache_requests_total",
+    "Cache lookups by result, hit ratio is hit / (hit + miss).",
+    ["cache", "result"],
+)
+event_loop_lag = Histogram(
+    "blabhear_event_loop_lag_seconds",
+    "Delay between when the loop monitor asked to wake up and when it did.",
+)
+event_loop_stalls = Counter(
+    "blabhear_event_loop_stalls_total",
+    "Times the event loop was blocked past the threshold, by active command.",
+    ["command"],
+)
+slow_queries = Counter(
+    "blabhear_slow_queries_total",
+    "Database queries slower than SLOW_QUERY_MS, by command.",
+    ["command"],
+)
+channel_layer_deliveries = Counter(
+    "blabhear_channel_layer_deliveries_total",
+    "Channel layer messages by whether they were delivered in memory or via Redis.",
+    ["path"],
+)
+channel_layer_drops = Counter(
+    "blabhear_channel_layer_drops_total",
+    "Messages for local channels dropped because the channel's queue was full.",
+    ["reason"],
+)
+presence_broadcasts = Counter(
+    "blabhear_presence_broadcasts_total",
+    "Presence updates broadcast to a room, or coalesced into a pending broadcast.",
+    ["result"],
+)
+notification_reads = Counter(
+    "blabhear_notification_reads_total",
+    "Notification read flags buffered, flushed, failed and retried, or dropped.",
+    ["result"],
+)
+room_events = Counter(
+    "blabhear_room_events_total",
+    "Room events logged, replayed on resume, or gaps that needed a full bootstrap.",
+    ["result"],
+)
+db_lane_threads = Gauge(
+    "blabhear_db_lane_threads",
+    "Threads available to each database executor lane.",
+    ["lane"],
+)
+db_lane_running = Gauge(
+    "blabhear_db_lane_running",
+    "Database calls running on each executor lane.",
+    ["lane"],
+)
+db_lane_queued = Gauge(
+    "blabhear_db_lane_queued",
+    "Database calls waiting for a thread on each executor lane.",
+    ["lane"],
+)
+db_lane_wait_seconds = Histogram(
+    "blabhear_db_lane_wait_seconds",
+    "Time database calls spent queued for an executor lane thread.",
+    ["lane"],
+)
+db_lane_rejected = Counter(
+    "blabhear_db_lane_rejected_total",
+    "Database calls rejected because their executor lane queue was full.",
+    ["lane"],
+)
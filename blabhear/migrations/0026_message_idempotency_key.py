@@ -0,0 +1,22 @@
+# Generated by Django 3.2.16 on 2026-10-18 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0025_recordingsettings_voice_effect'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='idempotency_key',
+            field=models.CharField(blank=True, default=None, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('creator', 'idempotency_key'), name='unique_message_idempotency_key_per_creator'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.16 on 2026-10-18 23:57
+
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+CREATE_SEARCH_VECTOR = """
+CREATE INDEX message_search_vector_idx ON blabhear_message USING gin (search_vector);
+CREATE TRIGGER message_search_vector_update
+    BEFORE INSERT OR UPDATE OF content ON blabhear_message
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search_vector, 'pg_catalog.simple', content);
+UPDATE blabhear_message SET search_vector = to_tsvector('pg_catalog.simple', content);
+"""
+
+DROP_SEARCH_VECTOR = """
+DROP TRIGGER IF EXISTS message_search_vector_update ON blabhear_message;
+DROP INDEX IF EXISTS message_search_vector_idx;
+"""
+
+
+def create_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_SEARCH_VECTOR)
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_SEARCH_VECTOR)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0026_message_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-created_at'], name='message_room_created_at_idx'),
+        ),
+        migrations.RunPython(create_search_vector, reverse_code=drop_search_vector),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-19 00:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0027_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('edited_at__isnull', False)), fields=['room', 'edited_at'], name='message_room_edited_at_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-19 00:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0028_message_room_edited_at_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='unique_message_idempotency_key_per_creator',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('creator', 'room', 'idempotency_key'), name='unique_message_idempotency_key_per_creator_room'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 import uuid
 
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import gettext_lazy as _
@@ -37,6 +38,28 @@ class Message(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     edited_at = models.DateTimeField(null=True, blank=True, default=None)
     filename = models.UUIDField(null=True, blank=True)
+    idempotency_key = models.CharField(
+        max_length=64, null=True, blank=True, default=None
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["creator", "room", "idempotency_key"],
+                name="unique_message_idempotency_key_per_creator_room",
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["room", "-created_at"], name="message_room_created_at_idx"
+            ),
+            models.Index(
+                fields=["room", "edited_at"],
+                name="message_room_edited_at_idx",
+                condition=models.Q(edited_at__isnull=False),
+            ),
+        ]
 
 
 class RecordingSettings(models.Model):
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import time
+from operator import itemgetter
+
+from blabhear import metrics
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = 30
+HEARTBEAT_INTERVAL = 10
+BROADCAST_DELAY = 0.25
+ACTIVITIES = ("recording", "typing")
+STATES = ("online",) + ACTIVITIES
+
+
+def collapse(connections):
+    # Presence is kept per connection, so a user with two tabs open stays
+    # online when one closes. Clients see one entry per user.
+    users = {}
+    for username, display_name in connections:
+        users[username] = display_name
+    return sorted(
+        (
+            {"username": username, "display_name": display_name}
+            for username, display_name in users.items()
+        ),
+        key=itemgetter("username"),
+    )
+
+
+class MemoryPresenceStore:
+    def __init__(self):
+        self.rooms = {}
+
+    def prune(self, room, now):
+        pruned = 0
+        for connections in room.values():
+            for channel, (expires_at, *_) in list(connections.items()):
+                if expires_at <= now:
+                    del connections[channel]
+                    pruned += 1
+        return pruned
+
+    async def update(self, room_id, channel, username, display_name, active_states):
+        now = time.time()
+        room = self.rooms.setdefault(room_id, {state: {} for state in STATES})
+        changed = self.prune(room, now)
+        for state in STATES:
+            if state in active_states:
+                changed += channel not in room[state]
+                room[state][channel] = (now + PRESENCE_TTL, username, display_name)
+            else:
+                changed += room[state].pop(channel, None) is not None
+        if not any(room.values()):
+            del self.rooms[room_id]
+        return changed > 0
+
+    async def snapshot(self, room_id):
+        room = self.rooms.get(room_id, {})
+        self.prune(room, time.time())
+        return {
+            state: collapse(
+                (username, display_name)
+                for expires_at, username, display_name in room.get(state, {}).values()
+            )
+            for state in STATES
+        }
+
+
+class RedisPresenceStore:
+    # One sorted set of connections per (room, state) scored by expiry time,
+    # plus a short-lived key per connection holding its user, so expired
+    # heartbeats are pruned on every update and read.
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def connection(self, room_id):
+        return self.channel_layer.connection(
+            self.channel_layer.consistent_hash(room_id)
+        )
+
+    async def update(self, room_id, channel, username, display_name, active_states):
+        now = time.time()
+        user_key = f"blabhear:presence:{room_id}:connection:{channel}"
+        async with self.connection(room_id) as connection:
+            transaction = connection.multi_exec()
+            changes = []
+            for state in STATES:
+                key = f"blabhear:presence:{room_id}:{state}"
+                changes.append(transaction.zremrangebyscore(key, max=now))
+                if state in active_states:
+                    changes.append(transaction.zadd(key, now + PRESENCE_TTL, channel))
+                    transaction.expire(key, PRESENCE_TTL)
+                else:
+                    changes.append(transaction.zrem(key, channel))
+            if active_states:
+                transaction.set(
+                    user_key, json.dumps([username, display_name]), expire=PRESENCE_TTL
+                )
+            else:
+                transaction.delete(user_key)
+            await transaction.execute()
+        return any(change.result() for change in changes)
+
+    async def snapshot(self, room_id):
+        now = time.time()
+        async with self.connection(room_id) as connection:
+            transaction = connection.multi_exec()
+            for state in STATES:
+                key = f"blabhear:presence:{room_id}:{state}"
+                transaction.zremrangebyscore(key, max=now)
+                transaction.zrange(key, 0, -1, encoding="utf-8")
+            results = await transaction.execute()
+            channels = {
+                state: results[2 * index + 1] for index, state in enumerate(STATES)
+            }
+            every_channel = sorted(set().union(*channels.values()))
+            users = {}
+            if every_channel:
+                values = await connection.mget(
+                    *(
+                        f"blabhear:presence:{room_id}:connection:{channel}"
+                        for channel in every_channel
+                    ),
+                    encoding="utf-8",
+                )
+                users = {
+                    channel: json.loads(value)
+                    for channel, value in zip(every_channel, values)
+                    if value is not None
+                }
+        return {
+            state: collapse(
+                users[channel] for channel in channels[state] if channel in users
+            )
+            for state in STATES
+        }
+
+
+memory_store = MemoryPresenceStore()
+pending_broadcasts = {}
+
+
+def get_store(channel_layer):
+    if hasattr(channel_layer, "connection") and hasattr(
+        channel_layer, "consistent_hash"
+    ):
+        return RedisPresenceStore(channel_layer)
+    return memory_store
+
+
+def schedule_broadcast(channel_layer, store, room_id):
+    # Changes within BROADCAST_DELAY of each other go out as one snapshot.
+    if room_id in pending_broadcasts:
+        metrics.presence_broadcasts.inc(result="coalesced")
+        return
+    pending_broadcasts[room_id] = asyncio.create_task(
+        broadcast(channel_layer, store, room_id)
+    )
+
+
+async def broadcast(channel_layer, store, room_id):
+    try:
+        await asyncio.sleep(BROADCAST_DELAY)
+    finally:
+        pending_broadcasts.pop(room_id, None)
+    try:
+        snapshot = await store.snapshot(room_id)
+        await channel_layer.group_send(room_id, {"type": "presence", **snapshot})
+        metrics.presence_broadcasts.inc(result="sent")
+    except Exception:
+        logger.exception(f"Failed to broadcast presence for room {room_id}")
@@ -0,0 +1,296 @@
+import asyncio
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import sys
+import time
+import weakref
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.functions import Now
+
+from blabhear import metrics
+from blabhear.instrumentation import current_command, database_sync_to_async
+from blabhear.models import Notification
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 500
+FLUSH_MAX_ATTEMPTS = 5
+
+# A read is recorded with the newest message the user was shown, and only
+# flips a notification that still points at that message. A message that
+# arrived after the user opened the room leaves it unread, whatever the app
+# servers' and database's clocks say.
+FLUSH_SQL = """
+UPDATE blabhear_notification notification
+SET read = true, timestamp = now()
+FROM (VALUES {values}) AS pending (user_id, room_id, message_id)
+WHERE notification.user_id = pending.user_id
+AND notification.room_id = pending.room_id
+AND NOT notification.read
+AND notification.message_id IS NOT DISTINCT FROM pending.message_id
+"""
+
+
+def to_datetime(read_at):
+    return datetime.datetime.fromtimestamp(read_at, tz=datetime.timezone.utc)
+
+
+class MemoryReadBuffer:
+    def __init__(self):
+        self.pending = {}
+
+    async def record(self, user_id, room_id, message_id, read_at, attempts=0):
+        rooms = self.pending.setdefault(user_id, {})
+        if read_at >= rooms.get(room_id, (None, 0, 0))[1]:
+            rooms[room_id] = (message_id, read_at, attempts)
+
+    async def requeue(self, user_id, room_id, message_id, read_at, attempts):
+        # A failed read only goes back if no newer one has been recorded.
+        self.pending.setdefault(user_id, {}).setdefault(
+            room_id, (message_id, read_at, attempts)
+        )
+
+    async def pending_for(self, user_id):
+        return dict(self.pending.get(user_id, {}))
+
+    def drain(self):
+        pending, self.pending = self.pending, {}
+        return [
+            (user_id, room_id, *read)
+            for user_id, rooms in pending.items()
+            for room_id, read in rooms.items()
+        ]
+
+    async def take(self):
+        return self.drain()
+
+
+class RedisReadBuffer:
+    # One hash of room -> read time per user, and a set of the users that
+    # have reads waiting. Everything lives on one shard so a flush can take
+    # and clear it in a single transaction.
+
+    users_key = "blabhear:reads:users"
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def connection(self):
+        return self.channel_layer.connection(
+            self.channel_layer.consistent_hash(self.users_key)
+        )
+
+    async def record(self, user_id, room_id, message_id, read_at, attempts=0):
+        async with self.connection() as connection:
+            multi = connection.multi_exec()
+            multi.hset(
+                f"blabhear:reads:{user_id}",
+                room_id,
+                json.dumps([message_id, read_at, attempts]),
+            )
+            multi.sadd(self.users_key, user_id)
+            await multi.execute()
+
+    async def requeue(self, user_id, room_id, message_id, read_at, attempts):
+        async with self.connection() as connection:
+            multi = connection.multi_exec()
+            multi.hsetnx(
+                f"blabhear:reads:{user_id}",
+                room_id,
+                json.dumps([message_id, read_at, attempts]),
+            )
+            multi.sadd(self.users_key, user_id)
+            await multi.execute()
+
+    async def pending_for(self, user_id):
+        async with self.connection() as connection:
+            pending = await connection.hgetall(
+                f"blabhear:reads:{user_id}", encoding="utf-8"
+            )
+        return {room_id: tuple(json.loads(read)) for room_id, read in pending.items()}
+
+    async def take(self):
+        async with self.connection() as connection:
+            user_ids = await connection.smembers(self.users_key, encoding="utf-8")
+            if not user_ids:
+                return []
+            multi = connection.multi_exec()
+            for user_id in user_ids:
+                multi.hgetall(f"blabhear:reads:{user_id}", encoding="utf-8")
+                multi.delete(f"blabhear:reads:{user_id}")
+            multi.srem(self.users_key, *user_ids)
+            results = await multi.execute()
+        return [
+            (int(user_id), room_id, *json.loads(read))
+            for user_id, pending in zip(user_ids, results[::2])
+            for room_id, read in pending.items()
+        ]
+
+
+memory_buffer = MemoryReadBuffer()
+flushing_loops = weakref.WeakKeyDictionary()
+
+
+def get_buffer(channel_layer):
+    if hasattr(channel_layer, "connection") and hasattr(
+        channel_layer, "consistent_hash"
+    ):
+        return RedisReadBuffer(channel_layer)
+    return memory_buffer
+
+
+async def mark_read(channel_layer, user_id, room_id, message_id):
+    start(channel_layer)
+    await get_buffer(channel_layer).record(
+        user_id, str(room_id), str(message_id) if message_id else None, time.time()
+    )
+    metrics.notification_reads.inc(result="buffered")
+
+
+async def apply_pending(channel_layer, user_id, notifications):
+    # The message id is only needed here, to match the pending reads.
+    message_ids = [notification.pop("message") for notification in notifications]
+    pending = await get_buffer(channel_layer).pending_for(user_id)
+    if not pending:
+        return notifications
+    for notification, message_id in zip(notifications, message_ids):
+        read = pending.get(str(notification["room"]))
+        if (
+            read is not None
+            and not notification["read"]
+            and read[0] == (str(message_id) if message_id else None)
+        ):
+            notification["read"] = True
+            notification["timestamp"] = to_datetime(read[1])
+    notifications.sort(key=itemgetter("timestamp"), reverse=True)
+    notifications.sort(key=itemgetter("read"))
+    return notifications
+
+
+def write_batch(batch):
+    if connection.vendor == "postgresql":
+        values = ", ".join(["(%s, %s::uuid, %s::uuid)"] * len(batch))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                FLUSH_SQL.format(values=values),
+                [
+                    value
+                    for user_id, room_id, message_id, *_ in batch
+                    for value in (user_id, room_id, message_id)
+                ],
+            )
+    else:
+        with transaction.atomic():
+            for user_id, room_id, message_id, *_ in batch:
+                Notification.objects.filter(
+                    user_id=user_id,
+                    room_id=room_id,
+                    read=False,
+                    message_id=message_id,
+                ).update(read=True, timestamp=Now())
+
+
+def write_reads(entries):
+    # Returns the entries that couldn't be written. A batch that fails is
+    # retried one entry at a time, so one bad row doesn't hold up the rest.
+    failed = []
+    for start_index in range(0, len(entries), FLUSH_BATCH_SIZE):
+        batch = entries[start_index : start_index + FLUSH_BATCH_SIZE]
+        try:
+            write_batch(batch)
+        except Exception:
+            logger.exception(f"Failed to flush {len(batch)} notification reads")
+            for entry in batch:
+                try:
+                    write_batch([entry])
+                except Exception:
+                    failed.append(entry)
+    return failed
+
+
+async def flush(channel_layer):
+    buffer = get_buffer(channel_layer)
+    entries = await buffer.take()
+    if not entries:
+        return
+    try:
+        failed = await database_sync_to_async(write_reads, lane="background")(entries)
+    except Exception:
+        logger.exception(f"Failed to flush {len(entries)} notification reads")
+        failed = entries
+    metrics.notification_reads.inc(len(entries) - len(failed), result="flushed")
+    for user_id, room_id, message_id, read_at, attempts in failed:
+        if attempts + 1 >= FLUSH_MAX_ATTEMPTS:
+            logger.error(
+                f"Dropping notification read for user {user_id} in room {room_id} "
+                f"after {FLUSH_MAX_ATTEMPTS} attempts"
+            )
+            metrics.notification_reads.inc(result="dropped")
+        else:
+            metrics.notification_reads.inc(result="failed")
+            await buffer.requeue(user_id, room_id, message_id, read_at, attempts + 1)
+
+
+async def run_flusher(channel_layer, lock):
+    current_command.set("flush_reads")
+    while True:
+        await asyncio.sleep(settings.READ_FLUSH_INTERVAL)
+        try:
+            async with lock:
+                await flush(channel_layer)
+        except Exception:
+            logger.exception("Failed to flush notification reads")
+
+
+async def flush_on_shutdown(channel_layer, lock, flusher):
+    # Waits for a flush that is already writing, then stops the flusher while
+    # it sleeps and writes whatever is left.
+    async with lock:
+        flusher.cancel()
+        try:
+            await flush(channel_layer)
+        except Exception:
+            logger.exception("Failed to flush notification reads on shutdown")
+
+
+def on_server_shutdown(callback):
+    # Daphne runs on Twisted's asyncio reactor, which waits for the Deferreds
+    # of "before shutdown" triggers while the event loop is still running.
+    reactor = sys.modules.get("twisted.internet.reactor")
+    if reactor is None or not reactor.running:
+        return
+    from twisted.internet.defer import Deferred
+
+    reactor.addSystemEventTrigger(
+        "before",
+        "shutdown",
+        lambda: Deferred.fromFuture(asyncio.ensure_future(callback())),
+    )
+
+
+def start(channel_layer):
+    loop = asyncio.get_running_loop()
+    if loop in flushing_loops:
+        return
+    lock = flushing_loops[loop] = asyncio.Lock()
+    # Started in an empty context, so the flusher doesn't inherit the replica
+    # session, command or tracing span of whichever connection started it.
+    flusher = contextvars.Context().run(
+        loop.create_task, run_flusher(channel_layer, lock)
+    )
+    on_server_shutdown(lambda: flush_on_shutdown(channel_layer, lock, flusher))
+
+
+@atexit.register
+def flush_on_exit():
+    # A fallback for servers without a shutdown hook. Reads buffered in Redis
+    # outlive the process, the in-memory ones don't.
+    entries = memory_buffer.drain()
+    if entries:
+        write_reads(entries)
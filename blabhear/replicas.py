@@ -0,0 +1,64 @@
+import contextvars
+import random
+import time
+
+from django.conf import settings
+
+current_database = contextvars.ContextVar("current_database", default=None)
+current_session = contextvars.ContextVar("current_session", default=None)
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+class ReplicaSession:
+    # Per WebSocket connection: once it writes, its reads stay on the primary
+    # for REPLICA_STICKY_SECONDS so it never reads behind its own writes.
+
+    def __init__(self):
+        self.primary_until = 0.0
+
+    def wrote(self):
+        self.primary_until = time.monotonic() + settings.REPLICA_STICKY_SECONDS
+
+    def sticky(self):
+        return time.monotonic() < self.primary_until
+
+
+def start_session():
+    current_session.set(ReplicaSession())
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith("replica_")]
+
+
+def read_database():
+    aliases = replica_aliases()
+    session = current_session.get()
+    if not aliases or (session is not None and session.sticky()):
+        return None
+    return random.choice(aliases)
+
+
+def is_write(sql):
+    return sql.lstrip()[:6].upper() in WRITE_STATEMENTS
+
+
+def record_write():
+    session = current_session.get()
+    if session is not None:
+        session.wrote()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return current_database.get()
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
@@ -5,4 +5,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r"ws/user/(?P<user_id>.+)/$", consumers.UserConsumer.as_asgi()),
     re_path(r"ws/room/$", consumers.RoomConsumer.as_asgi()),
+    re_path(r"ws/multiplex/$", consumers.MultiplexConsumer.as_asgi()),
 ]
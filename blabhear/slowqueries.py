@@ -0,0 +1,68 @@
+import json
+import logging
+import random
+
+from django.conf import settings
+
+from blabhear import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+
+def enabled():
+    return settings.SLOW_QUERY_MS is not None
+
+
+def explainable(sql, many, connection):
+    statement = sql.lstrip().upper()
+    return (
+        connection.vendor == "postgresql"
+        and not many
+        and statement.startswith("SELECT")
+        and " FOR UPDATE" not in statement
+    )
+
+
+def explain(sql, params, connection):
+    # Use a raw cursor so the EXPLAIN neither goes back through the execute
+    # wrappers nor replaces the result set Django is about to read. Inside a
+    # transaction a savepoint keeps a failed EXPLAIN from aborting it.
+    with connection.connection.cursor() as cursor:
+        if connection.in_atomic_block:
+            cursor.execute("SAVEPOINT blabhear_explain")
+        try:
+            cursor.execute(EXPLAIN_PREFIX + sql, params)
+            return cursor.fetchone()[0]
+        finally:
+            if connection.in_atomic_block:
+                cursor.execute("ROLLBACK TO SAVEPOINT blabhear_explain")
+                cursor.execute("RELEASE SAVEPOINT blabhear_explain")
+
+
+def record(command, sql, params, many, duration, context):
+    if duration * 1000 < settings.SLOW_QUERY_MS:
+        return
+    metrics.slow_queries.inc(command=command)
+    connection = context["connection"]
+    entry = {
+        "event": "slow_query",
+        "command": command,
+        "duration_ms": round(duration * 1000, 3),
+        "database": connection.alias,
+        "sql": sql,
+    }
+    span = tracing.current_span.get()
+    if span is not None:
+        entry["trace_id"] = span.trace_id
+        entry["span_id"] = span.span_id
+    if (
+        explainable(sql, many, connection)
+        and random.random() < settings.SLOW_QUERY_EXPLAIN_SAMPLE_RATE
+    ):
+        try:
+            entry["plan"] = explain(sql, params, connection)
+        except Exception as error:
+            entry["plan_error"] = str(error)
+    logger.warning(json.dumps(entry, default=str))
@@ -4,6 +4,8 @@ import os
 from google.cloud import storage
 from google.oauth2 import service_account
 
+from blabhear.instrumentation import observe_signing
+
 gcp_storage_credentials = {
     "type": "service_account",
     "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
@@ -25,6 +27,7 @@ storage_client = storage.Client(
 )
 
 
+@observe_signing("PUT")
 def generate_upload_signed_url_v4(blob_name):
     bucket = storage_client.bucket(os.environ.get("GCP_UPLOAD_BUCKET"))
     blob = bucket.blob(blob_name)
@@ -38,6 +41,7 @@ def generate_upload_signed_url_v4(blob_name):
     return url
 
 
+@observe_signing("GET")
 def generate_download_signed_url_v4(blob_name):
     bucket = storage_client.bucket(os.environ.get("GCP_UPLOAD_BUCKET"))
     blob = bucket.blob(blob_name)
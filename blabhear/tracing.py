@@ -0,0 +1,136 @@
+import contextlib
+import contextvars
+import json
+import queue
+import secrets
+import threading
+import time
+
+from django.conf import settings
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# Finished spans are written as OTLP/JSON, one export request per line, which
+# is the format the OpenTelemetry Collector's otlpjsonfile receiver replays.
+class FileExporter:
+    def __init__(self, path, service_name):
+        self.path = path
+        self.resource = {
+            "attributes": [
+                {"key": "service.name", "value": {"stringValue": service_name}}
+            ]
+        }
+        self.spans = queue.SimpleQueue()
+        self.writer = threading.Thread(
+            target=self.write, name="trace-exporter", daemon=True
+        )
+        self.writer.start()
+
+    def export(self, span):
+        self.spans.put(span)
+
+    def write(self):
+        with open(self.path, "a") as output:
+            while True:
+                batch = [self.spans.get()]
+                while not self.spans.empty() and len(batch) < 512:
+                    batch.append(self.spans.get())
+                request = {
+                    "resourceSpans": [
+                        {
+                            "resource": self.resource,
+                            "scopeSpans": [
+                                {
+                                    "scope": {"name": "blabhear"},
+                                    "spans": [span.to_otlp() for span in batch],
+                                }
+                            ],
+                        }
+                    ]
+                }
+                output.write(json.dumps(request) + "\n")
+                output.flush()
+
+
+exporter = None
+exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global exporter
+    if exporter is None and settings.TRACING_FILE:
+        with exporter_lock:
+            if exporter is None:
+                exporter = FileExporter(
+                    settings.TRACING_FILE, settings.TRACING_SERVICE_NAME
+                )
+    return exporter
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    span_exporter = get_exporter()
+    if span_exporter is None:
+        yield None
+        return
+    new_span = Span(name, current_span.get(), attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        new_span.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        new_span.end_ns = time.time_ns()
+        current_span.reset(token)
+        span_exporter.export(new_span)
+
+
+def set_attribute(key, value):
+    active_span = current_span.get()
+    if active_span is not None:
+        active_span.set_attribute(key, value)
@@ -0,0 +1,19 @@
+import os
+
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+
+from blabhear import metrics as blabhear_metrics
+
+
+def metrics(request):
+    # Metrics show per-command and per-room traffic, so they stay off unless a
+    # token is configured.
+    token = os.environ.get("METRICS_TOKEN")
+    if not token:
+        return HttpResponseNotFound()
+    if request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+    return HttpResponse(
+        blabhear_metrics.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -85,6 +85,32 @@ WSGI_APPLICATION = "server.wsgi.application"
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
 DATABASES = {"default": dj_database_url.config(conn_max_age=600)}
+for index, replica_url in enumerate(
+    url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url
+):
+    DATABASES[f"replica_{index}"] = {
+        **dj_database_url.parse(replica_url, conn_max_age=600),
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_ROUTERS = ["blabhear.replicas.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+DATABASE_LANES = {
+    "interactive": {
+        "threads": int(os.environ.get("DB_LANE_INTERACTIVE_THREADS", 8)),
+        "queue_limit": int(os.environ.get("DB_LANE_INTERACTIVE_QUEUE_LIMIT", 500)),
+    },
+    "bulk": {
+        "threads": int(os.environ.get("DB_LANE_BULK_THREADS", 2)),
+        "queue_limit": int(os.environ.get("DB_LANE_BULK_QUEUE_LIMIT", 100)),
+    },
+    "background": {
+        "threads": int(os.environ.get("DB_LANE_BACKGROUND_THREADS", 1)),
+        "queue_limit": int(os.environ.get("DB_LANE_BACKGROUND_QUEUE_LIMIT", 200)),
+    },
+}
+ASYNC_DATABASE = os.environ.get("ASYNC_DATABASE") == "True"
+ASYNC_DATABASE_POOL_SIZE = int(os.environ.get("ASYNC_DATABASE_POOL_SIZE", 10))
+READ_FLUSH_INTERVAL = float(os.environ.get("READ_FLUSH_INTERVAL", 2))
 
 
 # Password validation
@@ -138,12 +164,37 @@ ASGI_APPLICATION = "server.asgi.application"
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "blabhear.layers.HybridRedisChannelLayer",
         "CONFIG": {
             "hosts": [os.environ.get("REDIS_URL")],
         },
     },
 }
+
+# Shared by every process, so cached signed URLs and send_message dedupe
+# markers hold across workers.
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": os.environ.get("REDIS_URL"),
+    }
+}
+
+LOOP_MONITOR = bool(os.environ.get("LOOP_MONITOR") == "True")
+LOOP_MONITOR_INTERVAL_MS = int(os.environ.get("LOOP_MONITOR_INTERVAL_MS", 50))
+LOOP_MONITOR_THRESHOLD_MS = int(os.environ.get("LOOP_MONITOR_THRESHOLD_MS", 100))
+LOOP_MONITOR_STACK_DEPTH = int(os.environ.get("LOOP_MONITOR_STACK_DEPTH", 20))
+
+TRACING_FILE = os.environ.get("TRACING_FILE")
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "blabhear-backend")
+
+SLOW_QUERY_MS = (
+    float(os.environ["SLOW_QUERY_MS"]) if os.environ.get("SLOW_QUERY_MS") else None
+)
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(
+    os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0.1)
+)
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 if not LOCAL: